@@ -0,0 +1,126 @@
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fb_parse
+
+def read_names(path):
+    """Read an export,name CSV mapping each export to its owner's name."""
+    with open(path, newline='') as f:
+        return {row[0]: row[1] for row in csv.reader(f)
+                if len(row) >= 2 and row[1] and row[0] != 'export'}
+
+def find_exports(exports_dir):
+    """Return a {user: export paths} mapping of the exports in a directory.
+
+    Each entry is one user's export: an unzipped export directory, a zip
+    file, or a directory holding the parts of a split zip download. Users
+    are named by the entry, less any .zip extension.
+    """
+    users = dict()
+    for entry in sorted(os.listdir(exports_dir)):
+        path = os.path.join(exports_dir, entry)
+        if os.path.isdir(path):
+            zips = sorted(os.path.join(path, f) for f in os.listdir(path)
+                          if f.endswith('.zip'))
+            if zips and not os.path.isdir(os.path.join(path, 'friends')):
+                users[entry] = zips
+            else:
+                users[entry] = [path]
+        elif entry.endswith('.zip'):
+            users[entry[:-len('.zip')]] = [path]
+    return users
+
+def run_user(user, name, export, out_dir, options=()):
+    """Run every stage for one user's export, return a summary dict.
+
+    The user's database, chart cache, graphs and a log of the run's
+    output go in out_dir/user. Failures are caught and summarised rather
+    than raised, so one bad export does not stop the batch.
+    """
+    user_dir = os.path.join(out_dir, user)
+    os.makedirs(user_dir, exist_ok=True)
+    argv = ['all', '--name', name, '--export'] + list(export) + [
+        '--db', os.path.join(user_dir, 'facebook.sql'),
+        '--store', os.path.join(user_dir, 'facebook_store'),
+        '--cache', os.path.join(user_dir, 'chart_cache'),
+        '--out', os.path.join(user_dir, 'graphs'),
+        '--incremental'] + list(options)
+    start = time.time()
+    status, error = 'ok', None
+    with open(os.path.join(user_dir, 'log.txt'), 'w') as log:
+        with redirect_stdout(log), redirect_stderr(log):
+            try:
+                fb_parse.main(argv)
+            except (Exception, SystemExit) as e:
+                traceback.print_exc()
+                status = 'failed'
+                error = '{}: {}'.format(type(e).__name__, e)
+    return {'user': user, 'name': name, 'status': status, 'error': error,
+            'seconds': time.time() - start, 'out': user_dir}
+
+def run_batch(exports_dir, names, out_dir, jobs=1, options=()):
+    """Process every export in exports_dir, at most jobs at a time.
+
+    names maps users (see find_exports()) to their names on Facebook;
+    exports without a name fail without being run. Returns the list of
+    per-user summaries, in user order.
+    """
+    results = dict()
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = dict()
+        for user, export in find_exports(exports_dir).items():
+            if user not in names:
+                results[user] = {'user': user, 'name': None,
+                                 'status': 'failed', 'seconds': 0.0,
+                                 'error': 'no name in mapping', 'out': None}
+                continue
+            futures[pool.submit(run_user, user, names[user], export,
+                                out_dir, options)] = user
+        for future in as_completed(futures):
+            r = future.result()
+            results[r['user']] = r
+            print('{:<8} {} ({:.1f}s)'.format(r['status'], r['user'],
+                                              r['seconds']))
+    return [results[u] for u in sorted(results)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Chart the activity in many Facebook data exports.')
+    parser.add_argument('exports', help='directory with one export per '
+                        'user, as a directory or zip file(s)')
+    parser.add_argument('names', help='CSV of export,name rows giving '
+                        'each export owner\'s name on Facebook')
+    parser.add_argument('--out', default='batch',
+                        help='output directory, with one directory per user')
+    parser.add_argument('--jobs', type=int, default=fb_parse.WORKERS,
+                        help='users processed concurrently')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes within each user\'s job')
+    parser.add_argument('--backend', choices=['sqlite', 'columnar'],
+                        default='sqlite', help='event storage backend')
+    parser.add_argument('--cohorts', choices=['auto', 'skip'],
+                        default='auto', help='how to assign friend cohorts')
+    parser.add_argument('--text', choices=fb_parse.TEXT_MODES, default='keep',
+                        help='where description and title text is stored')
+    args = parser.parse_args()
+
+    options = ['--workers', str(args.workers), '--backend', args.backend,
+               '--cohorts', args.cohorts, '--text', args.text]
+    results = run_batch(args.exports, read_names(args.names), args.out,
+                        args.jobs, options)
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, 'summary.json'), 'w') as f:
+        json.dump(results, f, indent=1)
+    failed = [r for r in results if r['status'] != 'ok']
+    print('{} of {} users succeeded'.format(len(results) - len(failed),
+                                            len(results)))
+    for r in failed:
+        print('  {}: {}'.format(r['user'], r['error']))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,404 @@
+import io
+import re
+import os
+import json
+import time
+import pickle
+import random
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+import fb_parse
+import fb_synth
+from fb_sql import *
+
+# SQL_ESTIMATE_REMOVED_FRIENDS as a correlated subquery, for comparison
+_SQL_ESTIMATE_CORRELATED = """
+INSERT INTO facebook (action, action_type, person, timestamp)
+SELECT 'accepted_est', 'friend', f.person, (
+  SELECT min(timestamp) FROM facebook
+  WHERE action != 'removed' AND (person = f.person OR with = f.person)
+    AND timestamp <= f.timestamp) AS est_date
+FROM facebook f
+WHERE action_type = 'friend' AND action = 'removed'
+  AND est_date is not null;
+"""
+
+# Title templates resembling those found in a Facebook export
+_title_templates = [
+    "{me} wrote on {other}'s timeline.",
+    "{other} wrote on your timeline.",
+    "{me} likes {other}'s post.",
+    "{me} liked {other}'s photo.",
+    "{me} reacted to {other}'s comment.",
+    "{me} shared a link to {other}'s timeline.",
+    "{me} shared a photo to your own timeline.",
+    "{me} posted in {other}.",
+    "{me} commented on {other}'s post.",
+    "{me} replied to {other}'s comment.",
+    "{me} updated their status.",
+    "{me} was tagged in a photo with {other} at a very long venue name "
+    "that goes on for quite a while before the title finally ends.",
+    "{other} shared a memory.",
+    ]
+
+def make_titles(n, me='Pat Doe', seed=0):
+    """Return a list of n synthetic action titles."""
+    rand = random.Random(seed)
+    others = ['Friend %d' % i for i in range(500)]
+    return [rand.choice(_title_templates).format(me=me,
+                                                 other=rand.choice(others))
+            for _ in range(n)]
+
+def _parse_title_sequential(action):
+    """parse_title() as it ran before compiled matching, for comparison."""
+    if action.get('title'):
+        names = None
+        for p in fb_parse._fb_title_patterns:
+            match = re.search(p, action['title'])
+            if match:
+                names = list(match.groups())
+                break
+        if names and len(names) == 2:
+            if names[1] == 'your' or ' own ' in names[1]:
+                names[1] = fb_parse.ME
+            else:
+                names[1] = names[1].split("'")[0]
+            action['person'] = names[0]
+            action['with'] = names[1]
+        elif action['title'].startswith(fb_parse.ME):
+            action['person'] = fb_parse.ME
+            action['with'] = None
+    return action
+
+def bench_titles(n=50000, me='Pat Doe'):
+    """Time parse_title() against the sequential matcher over n titles."""
+    fb_parse.ME = me
+    titles = make_titles(n, me)
+    results = {}
+    for name, func in (('sequential', _parse_title_sequential),
+                       ('compiled', fb_parse.parse_title)):
+        start = time.perf_counter()
+        parsed = [func({'title': t}) for t in titles]
+        results[name] = (time.perf_counter() - start, parsed)
+    assert results['sequential'][1] == results['compiled'][1]
+    seq, comp = results['sequential'][0], results['compiled'][0]
+    print('parse_title over {:,} titles: sequential {:.2f}s, compiled '
+          '{:.2f}s ({:.1f}x)'.format(n, seq, comp, seq / comp))
+    return {'titles': n, 'sequential': seq, 'compiled': comp}
+
+def make_db(rows, people=5000, removed=1000, seed=0):
+    """Return an in-memory database with a synthetic facebook table."""
+    rand = random.Random(seed)
+    db = sqlite3.connect(':memory:')
+    db.execute(SQL_CREATE)
+    names = ['Friend %d' % i for i in range(people)]
+    actions = [('message', 'message'), ('comment', 'comment'),
+               ('LIKE', 'like'), ('post', 'post'), ('accepted', 'friend')]
+    data = list()
+    for _ in range(rows):
+        action, action_type = rand.choice(actions)
+        other = rand.choice(names) if rand.random() < 0.5 else None
+        data.append((action, action_type, rand.choice(names), other,
+                     rand.randint(1262304000, 1540000000)))
+    for name in rand.sample(names, removed):
+        data.append(('removed', 'friend', name, None,
+                     rand.randint(1262304000, 1540000000)))
+    db.executemany("INSERT INTO facebook (action, action_type, person, "
+                   "with, timestamp, fb_time) VALUES (?, ?, ?, ?, ?, ?);",
+                   [r + (r[-1],) for r in data])
+    db.commit()
+    return db
+
+def bench_removed_friends(rows=100000, removed=500):
+    """Time the correlated vs. set-based removed friend estimate."""
+    results = {}
+    for name, query, indexes in (
+            ('correlated', _SQL_ESTIMATE_CORRELATED, []),
+            ('set_based', SQL_ESTIMATE_REMOVED_FRIENDS, SQL_CREATE_INDEXES)):
+        db = make_db(rows, removed=removed)
+        start = time.perf_counter()
+        for q in indexes:
+            db.execute(q)
+        built = time.perf_counter()
+        db.execute(query)
+        done = time.perf_counter()
+        est = sorted(db.execute("SELECT person, timestamp FROM facebook "
+                                "WHERE action = 'accepted_est';"))
+        results[name] = {'index': built - start, 'estimate': done - built,
+                         'rows': est}
+        db.close()
+    assert results['correlated']['rows'] == results['set_based']['rows']
+    for name, r in results.items():
+        print('{} removed friend estimate over {:,} rows: {:.2f}s '
+              '(+{:.2f}s indexing)'.format(name, rows, r['estimate'],
+                                            r['index']))
+        del r['rows']
+    return results
+
+def _held(build):
+    """Return build()'s result and the bytes it holds, by tracemalloc."""
+    tracemalloc.start()
+    try:
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+def _insert_dicts(db, actions, batch_size=fb_parse.BATCH_SIZE):
+    """Bulk insert action dicts as load_rows() did before compact rows."""
+    cols = fb_parse._db_cols
+    batch = []
+    for i in actions:
+        batch.append(tuple(i.get(c) for c in cols))
+        if len(batch) >= batch_size:
+            db.executemany(fb_parse._insert_sql, batch)
+            batch = []
+    db.executemany(fb_parse._insert_sql, batch)
+    db.commit()
+
+def bench_rows(export, me='Pat Doe'):
+    """Compare action dicts with compact rows over an export.
+
+    Measures the memory a list of all the actions holds, their pickled
+    size as sent back from pool workers, and insert throughput.
+    """
+    fb_parse.ME = me
+    fb_parse.base_dir = os.path.abspath(export)
+    parse = lambda: [fb_parse.parse_title(i)
+                     for i in fb_parse.process_files()]
+    actions, dict_mem = _held(parse)
+    rows, row_mem = _held(lambda: [fb_parse.compact_row(i)
+                                   for i in parse()])
+    results = {'rows': len(rows)}
+    for name, data, mem, insert in (
+            ('dicts', actions, dict_mem, _insert_dicts),
+            ('compact', rows, row_mem,
+             lambda db, rows: fb_parse.load_rows(db, rows))):
+        db = sqlite3.connect(':memory:')
+        db.execute(SQL_CREATE)
+        start = time.perf_counter()
+        insert(db, data)
+        seconds = time.perf_counter() - start
+        db.close()
+        results[name] = {'held_bytes': mem, 'insert': seconds,
+                         'pickled_bytes': len(pickle.dumps(data))}
+        print('{} {:,} rows: {:.1f} MB held, {:.1f} MB pickled, insert '
+              '{:.2f}s'.format(name, len(data), mem / 1e6,
+                               results[name]['pickled_bytes'] / 1e6,
+                               seconds))
+    return results
+
+def _number_docs(chunk):
+    """Yield JSON objects with numbers across every buffer boundary."""
+    for number in ('7', '1.5', '-2e+3', '12.25E-1'):
+        for pad in range(chunk - 20, chunk):
+            yield '{"k": "%s", "v": %s}' % ('x' * pad, number)
+
+def bench_stream_json(export, me='Pat Doe', chunk_sizes=(16, 61, 1 << 10)):
+    """Check streamed reads match whole-file reads, at each buffer size.
+
+    Parses the export with _stream_json() at each of chunk_sizes, and
+    reads documents with numbers split by a buffer boundary, asserting
+    the results are the same as with json.load().
+    """
+    fb_parse.ME = me
+    fb_parse.base_dir = os.path.abspath(export)
+    start = time.perf_counter()
+    whole = list(fb_parse.process_files(stream=False))
+    results = {'rows': len(whole), 'whole': time.perf_counter() - start}
+    saved = fb_parse.CHUNK_SIZE
+    try:
+        for chunk in chunk_sizes + (saved,):
+            fb_parse.CHUNK_SIZE = chunk
+            for doc in _number_docs(chunk):
+                streamed = list(fb_parse._stream_json(io.StringIO(doc)))
+                assert streamed == list(json.loads(doc).items()), doc
+            start = time.perf_counter()
+            assert list(fb_parse.process_files(stream=True)) == whole
+            results[chunk] = time.perf_counter() - start
+            print('streamed {:,} rows with {:,} char chunks: {:.2f}s '
+                  '(whole files {:.2f}s)'.format(len(whole), chunk,
+                                                 results[chunk],
+                                                 results['whole']))
+    finally:
+        fb_parse.CHUNK_SIZE = saved
+    return results
+
+def _rows(columns):
+    """Return chart data columns as a sorted list of rows, for comparing."""
+    rows = zip(*[[round(v, 6) if isinstance(v, float) else v
+                  for v in c.tolist()] for c in columns])
+    return sorted(rows, key=repr)
+
+def bench_backends(export, me='Pat Doe'):
+    """Time the chart data from each backend, checking they agree.
+
+    The export is aggregated through SQLite, the columnar store and the
+    single-pass stream, each estimating removed friends' adds without
+    assigning cohorts, and all must give the same action and friend
+    data. Returns the seconds each backend took.
+    """
+    import fb_charts
+    import fb_store
+    import fb_stream
+    fb_parse.ME = me
+    fb_parse.base_dir = os.path.abspath(export)
+    cols = fb_parse._db_cols
+    timer = _Timer()
+    data = dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        with timer('sqlite'):
+            db, cur, parse = fb_parse.init_db(os.path.join(tmp, 'fb.sql'))
+            fb_parse.ingest(db)
+            for q in (SQL_ESTIMATE_REMOVED_FRIENDS, SQL_UPDATE_FRIEND_TABLE):
+                cur.execute(q)
+            db.commit()
+            data['sqlite'] = (
+                fb_charts.get_columns(cur, SQL_GET_ACTION_DATA, {'me': me}),
+                fb_charts.get_columns(cur, SQL_GET_FRIEND_DATA))
+            db.close()
+        with timer('columnar'):
+            path = os.path.join(tmp, 'store')
+            fb_store.write_store(path, fb_parse.ingest_actions(), cols)
+            store = fb_store.open_store(path)
+            data['columnar'] = (fb_store.get_action_data(store, me),
+                                fb_store.get_friend_data(store))
+        with timer('stream'):
+            totals = fb_stream.stream_totals(me, fb_parse.ingest_actions(),
+                                             cols)
+            data['stream'] = (totals.action_data(), totals.friend_data())
+    expected = [_rows(c) for c in data['sqlite']]
+    for name in ('columnar', 'stream'):
+        assert [_rows(c) for c in data[name]] == expected, name
+    return timer.stages
+
+class _Timer:
+    """Collect the wall time of named stages into a results dict."""
+
+    def __init__(self):
+        self.stages = dict()
+
+    def __call__(self, name):
+        self.name = name
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.stages[self.name] = time.perf_counter() - self.start
+        print('  {:<32} {:8.3f}s'.format(self.name, self.stages[self.name]))
+
+def bench_pipeline(export, me='Pat Doe', workers=1):
+    """Time each stage of the pipeline on an export, return results dict.
+
+    Stages are run in order against a scratch database: parsing, titles,
+    insert, indexing, each fb_sql.py post-processing statement, each
+    aggregation query, group_by() and each chart.
+    """
+    import fb_charts
+    fb_parse.ME = me
+    fb_parse.base_dir = os.path.abspath(export)
+    timer = _Timer()
+    with tempfile.TemporaryDirectory() as tmp:
+        with timer('parse'):
+            rows = list(fb_parse.process_files())
+        with timer('parse_title'):
+            rows = [fb_parse.parse_title(i) for i in rows]
+        with timer('compact_row'):
+            rows = [fb_parse.compact_row(i) for i in rows]
+        if workers > 1:
+            with timer('ingest_actions (%d workers)' % workers):
+                for _ in fb_parse.ingest_actions(workers):
+                    pass
+        db, cur, parse = fb_parse.init_db(os.path.join(tmp, 'facebook.sql'))
+        with timer('insert'):
+            fb_parse.load_rows(db, rows)
+        with timer('create_indexes'):
+            for q in SQL_CREATE_INDEXES:
+                cur.execute(q)
+            db.commit()
+        for name in ('SQL_DELETE_ESTIMATES', 'SQL_ESTIMATE_REMOVED_FRIENDS',
+                     'SQL_UPDATE_FRIEND_TABLE'):
+            with timer(name):
+                cur.execute(globals()[name])
+                db.commit()
+        # Deterministic cohorts stand in for the interactive prompt
+        cur.execute("UPDATE friends SET cohort = 'Group ' || (rowid % 4);")
+        db.commit()
+        with timer('SQL_GET_ACTION_DATA'):
+            action_data = fb_charts.get_columns(cur, SQL_GET_ACTION_DATA,
+                                                {'me': me})
+        with timer('SQL_GET_FRIEND_DATA'):
+            friend_data = fb_charts.get_columns(cur, SQL_GET_FRIEND_DATA)
+        with timer('group_by'):
+            for i in (1, 2):
+                fb_charts.group_by(action_data, group_index=i)
+            fb_charts.group_by(friend_data, group_index=1)
+        charts = dict()
+        fb_charts.draw_charts(action_data, friend_data, out_dir=tmp,
+                              times=charts)
+        for name, t in charts.items():
+            timer.stages['chart_' + name] = t
+        db.close()
+    return {'rows': len(rows), 'stages': timer.stages}
+
+def record(results, path='bench_results.jsonl', label=None):
+    """Append benchmark results to a JSON lines file, for comparison."""
+    if label is None:
+        try:
+            label = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                ).stdout.strip() or None
+        except OSError:
+            pass
+    entry = dict(results, label=label, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark each stage of the pipeline.')
+    parser.add_argument('--export', help='existing export to benchmark, '
+                        'otherwise a synthetic one is generated')
+    parser.add_argument('--name', default='Pat Doe')
+    parser.add_argument('--threads', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='messages per thread')
+    parser.add_argument('--friends', type=int, default=1000)
+    parser.add_argument('--albums', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--label', help='version label for the results')
+    parser.add_argument('--out', default='bench_results.jsonl',
+                        help='JSON lines file results are appended to')
+    parser.add_argument('--micro', action='store_true',
+                        help='also run the title, removed friend and row '
+                        'format micro-benchmarks, and check streamed JSON '
+                        'and each backend agree')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        export = args.export
+        scale = None
+        if export is None:
+            export = os.path.join(tmp, 'export')
+            scale = {'threads': args.threads, 'messages': args.messages,
+                     'friends': args.friends, 'albums': args.albums}
+            fb_synth.write_export(export, args.name, **scale)
+        print('Benchmarking ' + (args.export or 'synthetic export'))
+        results = bench_pipeline(export, args.name, args.workers)
+        if args.micro:
+            results['row_format'] = bench_rows(export, args.name)
+            results['stream_json'] = bench_stream_json(export, args.name)
+            results['backends'] = bench_backends(export, args.name)
+    results.update(scale=scale, workers=args.workers)
+    if args.micro:
+        results['titles'] = bench_titles(me=args.name)
+        results['removed_friends'] = bench_removed_friends()
+    record(results, args.out, args.label)
@@ -0,0 +1,49 @@
+import os
+import glob
+import hashlib
+
+def fingerprint(paths, *params):
+    """Return a cache key for the contents of paths and query parameters.
+
+    Files are identified by size and modification time rather than read,
+    so fingerprinting a large database is instant. Any write to a file
+    gives a new key.
+    """
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        st = os.stat(path)
+        h.update(repr((path, st.st_size, st.st_mtime_ns)).encode())
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+def cached_columns(cache_dir, key, compute):
+    """Return compute()'s column arrays, cached as .npz under key.
+
+    compute() only runs when cache_dir has no result for key, or when
+    cache_dir is None. Returns (columns, hit).
+    """
+    # NumPy is only needed here, not by the ingest stage's invalidate()
+    import numpy as np
+    if cache_dir is None:
+        return compute(), False
+    path = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(path, allow_pickle=True) as f:
+            return [f['arr_%d' % i] for i in range(len(f.files))], True
+    except FileNotFoundError:
+        pass
+    columns = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written under a temporary name, so readers never see part of a file
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, *columns)
+    os.replace(tmp, path)
+    return columns, False
+
+def invalidate(cache_dir):
+    """Remove every cached result in cache_dir, return how many."""
+    paths = glob.glob(os.path.join(cache_dir, '*.npz'))
+    for path in paths:
+        os.remove(path)
+    return len(paths)
@@ -0,0 +1,254 @@
+import os
+import re
+import time
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib import rcParams
+rcParams['font.sans-serif'] = ['Helvetica', 'Arial', 'sans-serif']
+import matplotlib.ticker as ticker
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import fb_instrument
+
+# Facebook-style colors for drawing charts
+_colors = {
+    'post': '#4260B4',
+    'dkblue': '#192648',
+    'comment': '#8ED66F',
+    'event': '#9B0024',
+    'friend': '#D2D5DA',
+    'like': '#5885FF',
+    'message': '#008BFF',
+    'badge': '#FF0017',
+    }
+
+def _factorize(col):
+    """Return the sorted unique values of an array and each row's index.
+
+    None is allowed alongside other values, and sorts last.
+    """
+    if col.dtype != object:
+        uniq, idx = np.unique(col, return_inverse=True)
+        return uniq.tolist(), idx
+    null = np.equal(col, None)
+    uniq, idx = np.unique(col[~null], return_inverse=True)
+    uniq = uniq.tolist()
+    full = np.full(len(col), len(uniq), dtype=np.intp)
+    full[~null] = idx
+    return (uniq + [None] if null.any() else uniq), full
+
+def group_by(data, group_index, where=None):
+    """Pivot query columns by the column in position i. Returns array dict.
+
+    data is a list of column arrays from get_columns(), with dates first and
+    the values to sum last; where optionally masks the rows to include.
+    """
+    if where is not None:
+        data = [c[where] for c in data]
+    dates, date_idx = _factorize(data[0])
+    keys, key_idx = _factorize(data[group_index])
+    # Sum values into a (key, date) grid in one pass
+    sums = np.bincount(key_idx * len(dates) + date_idx, weights=data[-1],
+                       minlength=len(keys) * len(dates))
+    sums = sums.reshape(len(keys), len(dates)).astype(data[-1].dtype)
+    dataframe = {'date': np.array(dates)}
+    for key, vals in zip(keys, sums):
+        dataframe[key] = vals
+    return dataframe
+
+def get_columns(cur, query, params=()):
+    """Fetch data from database as a list of NumPy column arrays."""
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    if not rows:
+        return [np.array([]) for _ in cur.description]
+    return [np.array(c) for c in zip(*rows)]
+
+def draw_chart(file_name, plotter, data, figsize, pct=False, out_dir='.'):
+    """Draw a figure using plotter function, save it as a png.
+
+    The figure is drawn on its own Agg canvas rather than through pyplot,
+    and cleared once saved. Returns the seconds taken.
+    """
+    start = time.time()
+    with fb_instrument.measure('chart', file_name):
+        # Initialize figure
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        try:
+            _draw_axes(fig.subplots(), file_name, plotter, data, pct)
+            # Draw PNG
+            fig.tight_layout()
+            fig.savefig(os.path.join(out_dir, file_name + '.png'))
+        finally:
+            fig.clear()
+    return time.time() - start
+
+def _render(chart, out_dir):
+    """Draw a chart in a pool worker, return its time and records."""
+    return draw_chart(*chart, out_dir=out_dir), fb_instrument.drain()
+
+def _draw_axes(ax, file_name, plotter, data, pct):
+    """Format chart axes and call the plotting function."""
+    # Set axis & tick parameters
+    ax.set_axisbelow(True)
+    ax.yaxis.grid()
+    ax.yaxis.set_tick_params(left=False, labelleft=True)
+    ax.yaxis.set_major_locator(ticker.MultipleLocator(50))
+    ax.xaxis.set_major_locator(ticker.MultipleLocator(1))
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+    # Override x-limits
+    ax.set_xlim([min(data['date']), max(data['date'])])
+    # If this is a % chart, set the tick and ylimits accordingly
+    if pct:
+        ax.yaxis.set_major_locator(ticker.MultipleLocator(0.25))
+        ax.yaxis.set_major_formatter(ticker.FuncFormatter('{0:.0%}'.format))
+        ax.set_ylim([0, 1])
+    # If this uses negatives to show other's posts, format away the minus
+    if file_name in ('wall_posts', 'messages'):
+        ax.yaxis.set_major_formatter(ticker.FuncFormatter(
+            lambda y, _: '{:,.0f}'.format(abs(y))
+            ))
+    # Call plotting function
+    plotter(ax, data)
+
+def add_title(ax, t):
+    ax.set_title(t, fontdict={'fontsize': 18}, loc='left')
+
+### Specific chart functions ###
+def posts_v_likes(ax, data):
+    """Draw stacked area chart of posts vs. likes."""
+    add_title(ax, 'Timeline of Facebook activity')
+    ax.set_ylabel('Actions per month')
+    ax.stackplot(data['date'], data['post'] + data['comment'] + data['event'],
+                 data['like'], labels=['Posts/Comments', 'Likes'],
+                 colors=[_colors['post'], _colors['like']],
+                 edgecolor='none')
+    ax.legend(loc='upper center')
+
+def pct_likes(ax, data):
+    """Draw area chart of % likes."""
+    add_title(ax, 'Likes as % of activity, by month')
+    ax.fill_between(data['date'], data['like'] / data['total'],
+                    color=_colors['like'])
+
+def friend_count(ax, data):
+    """Draw area chart of friend count."""
+    add_title(ax, 'Friends over time')
+    ax.fill_between(data['date'], data['total'], color=_colors['post'])
+    ax.set_ylim([0, data['total'].max()])
+
+def grouped_friend_count(ax, data):
+    """Draw stacked area chart of friend cohort counts."""
+    add_title(ax, 'Friend groups over time')
+    labs = [k for k in data.keys() if k not in ('date', 'total')]
+    ydat = [data[k] for k in labs]
+    ax.stackplot(data['date'], ydat, labels=labs)
+    ax.legend(loc='upper left')
+
+def post_balance(ax, data):
+    """Draw stacked area chart of post balance (me vs. others)."""
+    add_title(ax, 'Balance of Wall Posts, by month')
+    ax.fill_between(data['date'], data['other']*-1, color=_colors['comment'],
+                    label='Posts on my wall')
+    ax.stackplot(data['date'], data['me'], data['self'],
+                 colors=[_colors['like'], _colors['post']],
+                 labels=["My posts on other's walls",
+                         "My status updates / posts"])
+    handles, labels = ax.get_legend_handles_labels()
+    ax.legend(handles[::-1], labels[::-1], loc='upper center')
+
+def messages(ax, data):
+    """Draw stacked area chart of messages (sent vs. recieved)."""
+    add_title(ax, 'Facebook Messages (sent vs. recieved)')
+    ax.fill_between(data['date'], data['other']*-1, color=_colors['message'],
+                    label='Messages received')
+    ax.fill_between(data['date'], data['self'], color=_colors['message'],
+                    label='Messages sent')
+    ax.yaxis.set_major_locator(ticker.MultipleLocator(500))
+    ax.legend()
+
+def term_count(ax, data, term):
+    """Draw area chart of a search term's matches per month."""
+    add_title(ax, 'Monthly matches for "{}"'.format(term))
+    ax.fill_between(data['date'], data['count'], color=_colors['post'])
+    ax.yaxis.set_major_locator(ticker.MaxNLocator(integer=True))
+
+def draw_term_chart(term_data, term, out_dir='.'):
+    """Draw a search term's matches per month into out_dir.
+
+    term_data is the (fb_month, count) columns of SQL_GET_TERM_DATA.
+    Months without matches are charted as zero.
+    """
+    months, counts = term_data
+    if not len(months):
+        print('No matches to chart')
+        return
+    first = months.min()
+    counts = np.bincount(months - first, weights=counts).astype(np.int64)
+    data = {'date': (first + np.arange(len(counts))) / 12.0, 'count': counts}
+    name = 'search_' + re.sub(r'\W+', '_', term).strip('_').lower()
+    t = draw_chart(name, partial(term_count, term=term), data, (7, 5),
+                   out_dir=out_dir)
+    print('  {:<14} {:.2f}s'.format(name, t))
+
+def draw_charts(action_data, friend_data, workers=1, out_dir='.',
+                times=None):
+    """Draw all charts from action and friend data columns into out_dir.
+
+    With workers > 1 the charts are rendered concurrently in a process
+    pool. Prints the time taken by each chart, and records it by chart
+    name in times if given.
+    """
+    charts = list()
+    # Post vs. Likes Chart
+    actions = group_by(action_data, group_index=2)
+    charts.append(('timeline', posts_v_likes, actions, (7, 5), False))
+
+    # Percent Likes Chart
+    excl = ['date', 'friend', 'message']
+    actions['total'] = sum([v for k, v in actions.items() if k not in excl])
+    charts.append(('percent_likes', pct_likes, actions, (7, 5), True))
+
+    # Messages Chart
+    msgs = group_by(action_data, group_index=1,
+                    where=action_data[2] == 'message')
+    charts.append(('messages', messages, msgs, (7, 5), False))
+
+    # Post Balance Chart
+    posts = group_by(action_data, group_index=1,
+                     where=action_data[2] == 'post')
+    charts.append(('wall_posts', post_balance, posts, (7, 5), False))
+
+    # Friend Charts
+    friends = group_by(friend_data, group_index=1)
+    for k, v in friends.items():
+        friends[k] = np.cumsum(v) if k != 'date' else v
+    friends['total'] = sum([v for k, v in friends.items() if k != 'date'])
+    charts.append(('friends', friend_count, friends, (7, 5), False))
+    charts.append(('friends_cat', grouped_friend_count, friends, (7, 5),
+                   False))
+
+    start = time.time()
+    if workers <= 1:
+        elapsed = [draw_chart(*c, out_dir=out_dir) for c in charts]
+    else:
+        with ProcessPoolExecutor(min(workers, len(charts)),
+                                 initializer=fb_instrument.init_worker,
+                                 initargs=fb_instrument.state()) as pool:
+            futures = [pool.submit(_render, c, out_dir) for c in charts]
+            elapsed = list()
+            for f in futures:
+                t, records = f.result()
+                elapsed.append(t)
+                fb_instrument.add(records)
+    for c, t in zip(charts, elapsed):
+        print('  {:<14} {:.2f}s'.format(c[0], t))
+        if times is not None:
+            times[c[0]] = t
+    print('Drew {} charts in {:.2f}s'.format(len(charts), time.time() - start))
@@ -0,0 +1,121 @@
+import csv
+
+import numpy as np
+
+# Threads / groups with more members than this add no co-occurrence edges
+MAX_GROUP_SIZE = 100
+# Clusters smaller than this are put in the catch-all cohort
+MIN_COHORT_SIZE = 3
+OTHER_COHORT = 'Other'
+
+def membership_edges(members, index, max_size=MAX_GROUP_SIZE):
+    """Return co-occurrence edges from (group, person) membership pairs.
+
+    Every pair of indexed people sharing a message thread or FB group is
+    linked, weighted 1 / (members - 1) so large groups count for less.
+    Returns (src, dst, weight) arrays.
+    """
+    groups = dict()
+    for group, person in members:
+        if person in index:
+            groups.setdefault(group, set()).add(index[person])
+    src, dst, weight = list(), list(), list()
+    for people in groups.values():
+        k = len(people)
+        if k < 2 or k > max_size:
+            continue
+        people = np.fromiter(people, dtype=np.int64, count=k)
+        i, j = np.triu_indices(k, 1)
+        src.append(people[i])
+        dst.append(people[j])
+        weight.append(np.full(len(i), 1.0 / (k - 1)))
+    if not src:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+    return np.concatenate(src), np.concatenate(dst), np.concatenate(weight)
+
+def interaction_edges(pairs, index):
+    """Return edges from (person, with, count) comment / like interactions."""
+    pairs = [(index[p], index[w], n) for p, w, n in pairs
+             if p in index and w in index and p != w]
+    if not pairs:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+    src, dst, weight = (np.array(c) for c in zip(*pairs))
+    return src.astype(np.int64), dst.astype(np.int64), weight.astype(float)
+
+def _symmetric(n, edges):
+    """Combine edge lists into one symmetric, deduplicated sparse matrix."""
+    src = np.concatenate([e[0] for e in edges] + [e[1] for e in edges])
+    dst = np.concatenate([e[1] for e in edges] + [e[0] for e in edges])
+    weight = np.concatenate([e[2] for e in edges] * 2)
+    uniq, idx = np.unique(src * n + dst, return_inverse=True)
+    return uniq // n, uniq % n, np.bincount(idx, weights=weight)
+
+def label_propagation(n, src, dst, weight, iterations=50):
+    """Cluster a weighted graph of n nodes, return a label per node.
+
+    Each node repeatedly takes the label with the most edge weight among
+    its neighbours (ties to the smallest label). Alternate halves of the
+    nodes are updated each round, which stops labels oscillating.
+    """
+    labels = np.arange(n)
+    if not len(src):
+        return labels
+    for it in range(iterations):
+        # Total edge weight from each node to each neighbouring label
+        uniq, idx = np.unique(src * n + labels[dst], return_inverse=True)
+        sums = np.bincount(idx, weights=weight)
+        node, label = uniq // n, uniq % n
+        order = np.lexsort((label, -sums, node))
+        node, label = node[order], label[order]
+        first = np.r_[True, node[1:] != node[:-1]]
+        best = labels.copy()
+        best[node[first]] = label[first]
+        turn = np.arange(n) % 2 == it % 2
+        new = np.where(turn, best, labels)
+        if np.array_equal(new, labels) and np.array_equal(best, labels):
+            break
+        labels = new
+    return labels
+
+def infer_cohorts(people, memberships, interactions,
+                  min_size=MIN_COHORT_SIZE):
+    """Cluster people into cohorts by how they co-occur in the data.
+
+    memberships is a list of (group, person) pair lists, e.g. message
+    threads and FB groups, and interactions are (person, with, count)
+    rows. Only the named people are clustered. Returns a
+    mapping of each person to 'Cohort 1', 'Cohort 2', ... by cluster size,
+    or OTHER_COHORT for people in clusters smaller than min_size.
+    """
+    people = sorted(set(people))
+    index = {p: i for i, p in enumerate(people)}
+    n = len(people)
+    edges = [membership_edges(m, index) for m in memberships]
+    edges.append(interaction_edges(interactions, index))
+    labels = label_propagation(n, *_symmetric(n, edges))
+    uniq, idx, counts = np.unique(labels, return_inverse=True,
+                                  return_counts=True)
+    # Number cohorts by size, largest first
+    rank = np.empty(len(uniq), np.int64)
+    rank[np.lexsort((uniq, -counts))] = np.arange(len(uniq))
+    names = ['Cohort %d' % (r + 1) if c >= min_size else OTHER_COHORT
+             for r, c in zip(rank, counts)]
+    return {p: names[i] for p, i in zip(people, idx)}
+
+def read_cohort_file(path):
+    """Read a person,cohort CSV mapping of manual cohort overrides.
+
+    Rows with a blank cohort are skipped, so an exported mapping can be
+    filled in partially.
+    """
+    with open(path, newline='') as f:
+        return {row[0]: row[1] for row in csv.reader(f)
+                if len(row) >= 2 and row[1] and row[0] != 'person'}
+
+def write_cohort_file(path, cohorts):
+    """Write a person to cohort mapping as CSV, for review and editing."""
+    with open(path, 'w', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(['person', 'cohort'])
+        for person, cohort in sorted(cohorts.items(), key=lambda r: r[0]):
+            out.writerow([person, cohort or ''])
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Instrumentation is opt-in, and off by default
+ENABLED = False
+TRACE_MEMORY = False
+_records = list()
+# Records of the measure() blocks in progress, which reset_peak() updates
+_open = list()
+_started = time.time()
+
+def enable(enabled=True, trace_memory=False):
+    """Turn recording on or off.
+
+    trace_memory records peak Python allocations per measurement with
+    tracemalloc, which slows the run down noticeably.
+    """
+    global ENABLED, TRACE_MEMORY
+    ENABLED = enabled
+    TRACE_MEMORY = enabled and trace_memory
+    if TRACE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def init_worker(enabled=False, trace_memory=False):
+    """Pool worker initializer: drop records inherited from the parent."""
+    del _records[:]
+    enable(enabled, trace_memory)
+
+def state():
+    """Return the init_worker() arguments matching current settings."""
+    return ENABLED, TRACE_MEMORY
+
+def _max_rss():
+    """Return this process's peak resident memory in KB, if known."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_peak():
+    """Start a new peak for peak_alloc(), if tracing memory.
+
+    Measurements in progress keep the peak so far, so nested blocks each
+    see the peak allocation of their own block.
+    """
+    if not TRACE_MEMORY:
+        return
+    peak = tracemalloc.get_traced_memory()[1]
+    for rec in _open:
+        rec['peak_alloc'] = max(rec['peak_alloc'], peak)
+    tracemalloc.reset_peak()
+
+def peak_alloc():
+    """Return the peak traced allocation since reset_peak(), or None."""
+    return tracemalloc.get_traced_memory()[1] if TRACE_MEMORY else None
+
+@contextmanager
+def measure(kind, name, **fields):
+    """Record the wall time and memory of the enclosed block.
+
+    Yields the record dict, so the block can fill in 'rows' or any other
+    field. Nothing is recorded unless instrumentation is enabled.
+    """
+    rec = dict(kind=kind, name=name, rows=None, **fields)
+    if not ENABLED:
+        yield rec
+        return
+    if TRACE_MEMORY:
+        reset_peak()
+        rec['peak_alloc'] = 0
+        _open.append(rec)
+    start = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        rec['seconds'] = time.perf_counter() - start
+        rec['max_rss_kb'] = _max_rss()
+        if TRACE_MEMORY:
+            _open[:] = [r for r in _open if r is not rec]
+            rec['peak_alloc'] = max(rec['peak_alloc'], peak_alloc())
+        _records.append(rec)
+
+def record(kind, name, seconds, rows=None, **fields):
+    """Record a measurement timed by the caller, if enabled."""
+    if ENABLED:
+        _records.append(dict(kind=kind, name=name, rows=rows,
+                             seconds=seconds, max_rss_kb=_max_rss(),
+                             **fields))
+
+def drain():
+    """Remove and return the records made so far in this process."""
+    recs = list(_records)
+    del _records[:]
+    return recs
+
+def add(records):
+    """Add records made elsewhere, e.g. returned by a pool worker."""
+    _records.extend(records)
+
+def summary(records):
+    """Total seconds and rows per kind of record."""
+    totals = dict()
+    for r in records:
+        t = totals.setdefault(r['kind'], {'count': 0, 'seconds': 0.0,
+                                          'rows': 0})
+        t['count'] += 1
+        t['seconds'] += r.get('seconds') or 0
+        t['rows'] += r.get('rows') or 0
+    return totals
+
+def write_report(path, **info):
+    """Write the records and a per-kind summary to a JSON report."""
+    records = drain()
+    report = dict(info, started=time.strftime(
+        '%Y-%m-%dT%H:%M:%S', time.localtime(_started)),
+        wall_seconds=time.time() - _started, max_rss_kb=_max_rss(),
+        summary=summary(records), records=records)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Wrote instrumentation report to ' + path)
+
+@contextmanager
+def profile(path):
+    """Run the enclosed block under cProfile, saving pstats data to path.
+
+    Only the current process is profiled, not pool workers. A path of
+    None disables profiling.
+    """
+    if path is None:
+        yield
+        return
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(path)
+        print('Wrote profile to {} (view with python -m pstats)'.format(
+            os.path.abspath(path)))
@@ -1,15 +1,17 @@
+import io
 import re
 import os
+import sys
+import hashlib
 import json
+import time
 import sqlite3
-from collections import defaultdict
-
-import numpy as np
-from matplotlib import rcParams
-rcParams['font.sans-serif'] = ['Helvetica', 'Arial', 'sans-serif']
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
+import fb_instrument
 from fb_sql import *
 
 # Facebook Title patterns to match against in parse_title()
@@ -26,30 +28,69 @@ _fb_title_patterns = [
     "(.+) commented on (.+)'s .*",
     "(.+) replied to (.+)",
     ]
+# Literal each pattern above requires, checked before running its regex
+_fb_title_keywords = [
+    " wrote on ", " like", " reacted to ", " shared a link to ",
+    " shared a photo to ", " shared an album to ", " shared a post to ",
+    " posted in ", " added a new photo to ", " commented on ", " replied to ",
+    ]
+_fb_title_matchers = [(k, re.compile(p).search)
+                      for k, p in zip(_fb_title_keywords, _fb_title_patterns)]
 
 # List of columns in the SQLite facebook table
 _db_cols = [
     'action', 'action_type', 'timestamp', 'description', 'person', 'with',
     'thread', 'title', 'url', 'fbgroup', 'camera_make', 'camera_model',
+    'fb_time', 'fb_month',
     ]
 
-# Facebook-style colors for drawing charts
-_colors = {
-    'post': '#4260B4',
-    'dkblue': '#192648',
-    'comment': '#8ED66F',
-    'event': '#9B0024',
-    'friend': '#D2D5DA',
-    'like': '#5885FF',
-    'message': '#008BFF',
-    'badge': '#FF0017',
-    }
+# Positions of the columns of repeated values, interned in compact_row()
+_interned_cols = [_db_cols.index(c) for c in
+                  ('action', 'action_type', 'person', 'with', 'thread')]
+
+# Prepared INSERT statement for the facebook table
+_insert_sql = "INSERT INTO facebook (" + ','.join(_db_cols) + ") VALUES (" + \
+    ','.join(['?']*len(_db_cols)) + ");"
+# The same, with an explicit id first, for lean ingests
+_insert_id_sql = "INSERT INTO facebook (id," + ','.join(_db_cols) + \
+    ") VALUES (" + ','.join(['?']*(len(_db_cols) + 1)) + ");"
+
+# Where load_rows() puts the free text columns: in the facebook table,
+# nowhere, or the facebook_text side table, optionally zlib-compressed
+TEXT_MODES = ['keep', 'drop', 'side', 'zlib']
+_text_cols = [_db_cols.index('description'), _db_cols.index('title')]
 
-def init_db():
-    """Open SQLite database, create facebook table, return connection."""
-    db = sqlite3.connect('facebook.sql')
+# Number of worker processes used by ingest_actions()
+WORKERS = os.cpu_count() or 1
+
+# Number of rows buffered per executemany call in load_rows()
+BATCH_SIZE = 5000
+
+# Characters read at a time by _stream_json()
+CHUNK_SIZE = 1 << 16
+_json_ws = re.compile(r'[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+# Characters that can follow a complete JSON number
+_json_delims = ',]} \t\n\r'
+
+def init_db(path='facebook.sql'):
+    """Open SQLite database, create facebook table, return connection.
+
+    Raises ValueError for a database made by an older version, whose
+    facebook table lacks columns this one needs.
+    """
+    db = sqlite3.connect(path)
     cur = db.cursor()
     cur.execute(SQL_CREATE)
+    cur.execute(SQL_GET_COLUMNS)
+    missing = set(['id'] + _db_cols) - {r[0] for r in cur.fetchall()}
+    if missing:
+        db.close()
+        raise ValueError('{} was made by an older version, without columns '
+                         '{}: delete it and rerun the ingest stage to '
+                         'rebuild it'.format(path, ', '.join(sorted(missing))))
+    cur.execute(SQL_CREATE_FRIENDS)
+    cur.execute(SQL_CREATE_TEXT)
     db.commit()
     cur.execute(SQL_CHECK)
     parse = list(cur.fetchall())[0][0] == 0
@@ -57,11 +98,14 @@ def init_db():
 
 def parse_title(action):
     """Extract names from an action's title and update the action in place."""
-    if action.get('title'):
+    title = action.get('title')
+    if title:
         names = None
-        # Check for matches against all defined title patterns
-        for p in _fb_title_patterns:
-            match = re.search(p, action['title'])
+        # Check for matches against the patterns whose keyword is present
+        for keyword, search in _fb_title_matchers:
+            if keyword not in title:
+                continue
+            match = search(title)
             if match:
                 names = list(match.groups())
                 break
@@ -74,12 +118,27 @@ def parse_title(action):
             action['person'] = names[0]
             action['with'] = names[1]
         # If the title starts with our name, it's a self-post
-        elif action['title'].startswith(ME):
+        elif title.startswith(ME):
             action['person'] = ME
             action['with'] = None
         # Otherwise, leave the action unchanged
     return action
 
+def parse_date(action):
+    """Set an action's timestamp in seconds and month bucket in place.
+
+    fb_time is the timestamp in seconds (messages are in milliseconds), and
+    fb_month counts months as year * 12 + month - 1, in UTC.
+    """
+    ts = action.get('timestamp')
+    if ts is not None:
+        if action['action'] == 'message':
+            ts //= 1000
+        t = time.gmtime(ts)
+        action['fb_time'] = ts
+        action['fb_month'] = t.tm_year * 12 + t.tm_mon - 1
+    return action
+
 def parse_data(action, data):
     """Parse an action's data field, return action with updated vals."""
     d = data['data'][0]
@@ -125,29 +184,204 @@ def parse_attachments(action, data):
         action['description'] = att['note']['title']
     return action
 
-def process_files():
-    """Normalize contents of Facebook data files for easier processing.
+def compact_row(action):
+    """Return an action dict as a tuple of its values in _db_cols order.
 
-    Goes through each Facebook data export directory / JSON file, and
-    normalizes the list into a series of dicts with the following keys:
-    -- action / action_type: categorization of action
-    -- timestamp: Unix timestamp of action
-    -- title: FB title of action
-    -- person: FB user who did action
-    -- with: FB user who action was done with/to (parsed from title)
-    -- fbgroup: FB group action was done in
-    -- description: comment / post text, album name, group name, etc.
-    -- thread: messages-only, ID of messanger thread
-    -- url: URL of shared link or photo
-    -- camera_make / camera_model: camera metadata from photos
-    Each action dict is emitted in sequence as a generator.
-    General FB JSON structure is to have a single key, whose value is
-    a list of actions / events.
+    This is the row format passed between ingest stages. Repeated strings
+    are interned, so the many rows of a thread or friend share one copy.
+    """
+    row = [action.get(c) for c in _db_cols]
+    for i in _interned_cols:
+        if type(row[i]) is str:
+            row[i] = sys.intern(row[i])
+    return tuple(row)
+
+# Open zip archives of exports in this process, keyed by archive paths, as
+# (stamp, archives, members) with the archives' (path, size, mtime_ns)
+_zip_exports = dict()
+# Export file a source reader opened last, which _read_task() credits
+# its rows to
+_last_opened = None
+
+def export_source(paths):
+    """Return the base for an export given as a directory or zip files.
+
+    A directory is used by path; one or more zip archives (e.g. a split
+    download) are used as a tuple of paths, and read in place without
+    extracting anything.
+    """
+    paths = [os.path.abspath(p) for p in paths]
+    if all(zipfile.is_zipfile(p) for p in paths):
+        return tuple(paths)
+    if len(paths) != 1:
+        raise ValueError('An export is one directory, or one or more zips')
+    return paths[0]
+
+def _zip_members(base):
+    """Map export-relative paths to (ZipFile, ZipInfo) for a zipped export.
+
+    Members are indexed once per process, and again if an archive is
+    replaced or changed. A folder wrapping the whole export inside the
+    archive is stripped from the paths.
     """
+    stamp = list()
+    for path in base:
+        st = os.stat(path)
+        stamp.append((path, st.st_size, st.st_mtime_ns))
+    cached = _zip_exports.get(base)
+    if cached and cached[0] == stamp:
+        return cached[2]
+    if cached:
+        for zf in cached[1]:
+            zf.close()
+    archives, members = list(), dict()
+    for path in base:
+        zf = zipfile.ZipFile(path)
+        archives.append(zf)
+        for info in zf.infolist():
+            if not info.is_dir():
+                members[info.filename] = (zf, info)
+    marker = 'friends/friends.json'
+    prefix = next((m[:-len(marker)] for m in members
+                   if m.endswith(marker)), '')
+    members = {m[len(prefix):]: v for m, v in members.items()
+               if m.startswith(prefix)}
+    _zip_exports[base] = (stamp, archives, members)
+    return members
+
+def close_exports():
+    """Close every zip archive of an export opened in this process."""
+    for stamp, archives, members in _zip_exports.values():
+        for zf in archives:
+            zf.close()
+    _zip_exports.clear()
+
+def _zip_member(base, rel):
+    """Return the (ZipFile, ZipInfo) of a file in a zipped export."""
+    try:
+        return _zip_members(base)[rel]
+    except KeyError:
+        raise FileNotFoundError('No {} in {}'.format(rel, ', '.join(base)))
+
+def _open(base, rel, mode='r'):
+    """Open a file of the export, in text ('r') or binary ('rb') mode."""
+    global _last_opened
+    _last_opened = rel
+    if not isinstance(base, tuple):
+        return open(os.path.join(base, rel), mode)
+    zf, info = _zip_member(base, rel)
+    f = zf.open(info)
+    return f if mode == 'rb' else io.TextIOWrapper(f, encoding='utf-8')
+
+def _listdir(base, rel):
+    """List the entries of a directory of the export."""
+    if not isinstance(base, tuple):
+        return os.listdir(os.path.join(base, rel))
+    prefix = rel.rstrip('/') + '/'
+    return list({m[len(prefix):].split('/')[0] for m in _zip_members(base)
+                 if m.startswith(prefix)})
 
-    # apps_and_websites
-    os.chdir(base_dir + 'apps_and_websites')
-    data = json.load(open('posts_from_apps_and_websites.json'))
+def _stat(base, rel):
+    """Return the (size, mtime) of a file of the export."""
+    if not isinstance(base, tuple):
+        st = os.stat(os.path.join(base, rel))
+        return st.st_size, st.st_mtime
+    zf, info = _zip_member(base, rel)
+    return info.file_size, time.mktime(info.date_time + (0, 0, -1))
+
+def _load_json(base, rel):
+    """Load a whole JSON file of the export."""
+    with _open(base, rel) as f:
+        return json.load(f)
+
+def _stream_json(f, arrays=()):
+    """Incrementally read a JSON object file, yielding (key, value) pairs.
+
+    Top-level members are decoded one at a time from a rolling buffer, so
+    memory is bounded by the largest single value rather than the file.
+    Arrays stored under a key in arrays are yielded element by element, as
+    (key, element) pairs, instead of being decoded whole.
+    """
+    with f:
+        buf, pos, eof = '', 0, False
+
+        def fill(need):
+            # Append at least need more characters to buf, unless at EOF
+            nonlocal buf, pos, eof
+            if pos > CHUNK_SIZE:
+                buf, pos = buf[pos:], 0
+            chunk = f.read(max(need, CHUNK_SIZE))
+            eof = not chunk
+            buf += chunk
+            return not eof
+
+        def skip(chars=''):
+            # Skip whitespace and any of chars, return the next character
+            nonlocal pos
+            while True:
+                pos = _json_ws.match(buf, pos).end()
+                if pos < len(buf) and buf[pos] in chars:
+                    pos += 1
+                elif pos < len(buf) or not fill(CHUNK_SIZE):
+                    return buf[pos:pos + 1]
+
+        def value():
+            # Decode one complete JSON value starting at pos
+            nonlocal pos
+            while True:
+                try:
+                    val, end = _json_decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if not fill(len(buf) - pos):
+                        raise
+                    continue
+                # A number cut off at the buffer's end, e.g. after its '.'
+                # or 'e', decodes as a shorter number: only trust one
+                # that is followed by a delimiter
+                if type(val) in (int, float):
+                    done = end < len(buf) and buf[end] in _json_delims
+                else:
+                    done = end < len(buf)
+                if done or not fill(CHUNK_SIZE):
+                    pos = end
+                    return val
+
+        if skip() != '{':
+            raise ValueError('Expected a JSON object in ' + str(f.name))
+        pos += 1
+        while skip(',') not in ('}', ''):
+            key = value()
+            skip(':')
+            if key in arrays and skip() == '[':
+                pos += 1
+                while skip(',') not in (']', ''):
+                    yield key, value()
+                pos += 1
+            else:
+                yield key, value()
+
+def _read_json(base, rel, arrays=(), stream=False):
+    """Yield (key, value) pairs from a JSON object file of the export.
+
+    With stream=True the file is read incrementally by _stream_json(),
+    otherwise it is loaded whole; either way arrays under a key in arrays
+    are yielded element by element, in file order.
+    """
+    if stream:
+        yield from _stream_json(_open(base, rel), arrays)
+        return
+    data = _load_json(base, rel)
+    for key, val in data.items():
+        if key in arrays:
+            for v in val:
+                yield key, v
+        else:
+            yield key, val
+
+def _read_apps(base, stream=True):
+    """Yield actions from apps_and_websites."""
+    data = _load_json(base, 'apps_and_websites/'
+                      'posts_from_apps_and_websites.json')
     for row in data['app_posts']:
         r = {'action': 'app_post', 'action_type': 'post', 'person': ME,
              'timestamp': row['timestamp'], 'title': row.get('title')}
@@ -157,9 +391,9 @@ def process_files():
             r = parse_attachments(r, row)
         yield r
 
-    # comments
-    os.chdir(base_dir + 'comments')
-    data = json.load(open('comments.json'))
+def _read_comments(base, stream=True):
+    """Yield actions from comments."""
+    data = _load_json(base, 'comments/comments.json')
     for row in data['comments']:
         com = row['data'][0]['comment']
         yield {'action': 'comment', 'action_type': 'comment',
@@ -167,14 +401,14 @@ def process_files():
                'description': com['comment'], 'fbgroup': com.get('group'),
                'title': row['title']}
 
-    # events
-    os.chdir(base_dir + 'events')
-    data = json.load(open('event_invitations.json'))
+def _read_events(base, stream=True):
+    """Yield actions from events."""
+    data = _load_json(base, 'events/event_invitations.json')
     for row in data['events_invited']:
         yield {'action': 'was_invited', 'action_type': 'event',
                'timestamp': row['start_timestamp'], 'description': row['name']}
 
-    data = json.load(open('your_event_responses.json'))
+    data = _load_json(base, 'events/your_event_responses.json')
     for row in data['event_responses']['events_joined']:
         yield {'action': 'accepted', 'action_type': 'event',
                'timestamp': row['start_timestamp'], 'description': row['name']}
@@ -185,127 +419,147 @@ def process_files():
         yield {'action': 'interested', 'action_type': 'event',
                'timestamp': row['start_timestamp'], 'description': row['name']}
 
-    data = json.load(open('your_events.json'))
+    data = _load_json(base, 'events/your_events.json')
     for row in data['your_events']:
         yield {'action': 'hosting', 'action_type': 'event',
                'timestamp': row['start_timestamp'], 'description': row['name']}
 
-    # friends
-    os.chdir(base_dir + 'friends')
-    data = json.load(open('friends.json'))
+def _read_friends(base, stream=True):
+    """Yield actions from friends."""
+    data = _load_json(base, 'friends/friends.json')
     for row in data['friends']:
         yield {'action': 'accepted', 'action_type': 'friend',
                'timestamp': row['timestamp'], 'person': row['name']}
-    data = json.load(open('received_friend_requests.json'))
+    data = _load_json(base, 'friends/received_friend_requests.json')
     for row in data['received_requests']:
         yield {'action': 'received_request', 'action_type': 'friend',
                'timestamp': row['timestamp'], 'person': row['name']}
-    data = json.load(open('rejected_friend_requests.json'))
+    data = _load_json(base, 'friends/rejected_friend_requests.json')
     for row in data['rejected_requests']:
         yield {'action': 'rejected', 'action_type': 'friend',
                'timestamp': row['timestamp'], 'person': row['name']}
-    data = json.load(open('removed_friends.json'))
+    data = _load_json(base, 'friends/removed_friends.json')
     for row in data['deleted_friends']:
         yield {'action': 'removed', 'action_type': 'friend',
                'timestamp': row['timestamp'], 'person': row['name']}
-    data = json.load(open('sent_friend_requests.json'))
+    data = _load_json(base, 'friends/sent_friend_requests.json')
     for row in data['sent_requests']:
         yield {'action': 'sent_request', 'action_type': 'friend',
                'timestamp': row['timestamp'], 'person': row['name']}
 
-    # groups
-    os.chdir(base_dir + 'groups')
-    data = json.load(open('your_groups.json'))
+def _read_groups(base, stream=True):
+    """Yield actions from groups."""
+    data = _load_json(base, 'groups/your_groups.json')
     for row in data['groups_admined']:
         yield {'action': 'group_admined', 'action_type': 'group_admined',
                'timestamp': row['timestamp'], 'description': row['name']}
 
-    # likes_and_reactions
-    os.chdir(base_dir + 'likes_and_reactions')
-    data = json.load(open('pages.json'))
+def _read_likes(base, stream=True):
+    """Yield actions from likes_and_reactions."""
+    data = _load_json(base, 'likes_and_reactions/pages.json')
     for row in data['page_likes']:
         yield {'action': 'like_page', 'action_type': 'like',
                'timestamp': row['timestamp'], 'title': row.get('title'),
                'description': row['data'][0]['name']}
 
-    data = json.load(open('posts_and_comments.json'))
+    data = _load_json(base, 'likes_and_reactions/posts_and_comments.json')
     for row in data['reactions']:
         react = row['data'][0]['reaction']
         yield {'action': react['reaction'], 'action_type': 'like',
                'timestamp': row['timestamp'], 'title': row.get('title'),
                'person': react['actor']}
 
-    # messages
-    os.chdir(base_dir + 'messages')
-    for chat in os.listdir():
-        if chat == 'stickers_used':
+def _read_chat(base, chat, stream=True):
+    """Yield actions from one messages/<chat> thread."""
+    path = 'messages/' + chat + '/message.json'
+    for key, row in _read_json(base, path, ('messages',), stream):
+        if key != 'messages':
             continue
-        data = json.load(open(chat + '/message.json'))
-        for row in data['messages']:
-            yield {'action': 'message', 'action_type': 'message',
-                   'timestamp': row['timestamp_ms'],
-                   'person': row.get('sender_name'),
-                   'thread': chat, 'description': row.get('content')}
-
-    # photos
-    os.chdir(base_dir + 'photos_and_videos/album')
-    for album in os.listdir():
-        data = json.load(open(album))
-        # Photo Album
-        yield {'action': 'album', 'action_type': 'post', 'person': ME,
-               'timestamp': data['last_modified_timestamp'],
-               'description': data['name']}
+        yield {'action': 'message', 'action_type': 'message',
+               'timestamp': row['timestamp_ms'],
+               'person': row.get('sender_name'),
+               'thread': chat, 'description': row.get('content')}
 
+def _read_album(base, album, stream=True):
+    """Yield actions from one photos_and_videos/album file."""
+    path = 'photos_and_videos/album/' + album
+    name, modified, pending = None, None, list()
+    for key, val in _read_json(base, path, ('comments', 'photos'), stream):
+        if key == 'name':
+            name = val
+            # Photos read before the album name can now be emitted
+            for photo in pending:
+                yield from _album_photo(photo, name)
+            pending = list()
+        elif key == 'last_modified_timestamp':
+            modified = val
         # Album Comments
-        for com in data.get('comments', list()):
+        elif key == 'comments':
             yield {'action': 'comment', 'action_type': 'comment',
-                   'timestamp': com['timestamp'], 'person': com['author'],
-                   'description': com['comment'], 'fbgroup': com.get('group')}
-
+                   'timestamp': val['timestamp'], 'person': val['author'],
+                   'description': val['comment'],
+                   'fbgroup': val.get('group')}
         # Photos
-        for photo in data['photos']:
-            if 'creation_timestamp' in photo:
-                ts = photo['creation_timestamp']
+        elif key == 'photos':
+            if name is None:
+                pending.append(val)
             else:
-                if 'comments' in photo:
-                    ts = min(c['timestamp'] for c in photo['comments'])
-                else:
-                    ts = None
-            r = {'action': 'album_photo', 'action_type': 'post',
-                 'timestamp': ts, 'url': photo['uri'], 'person': ME,
-                 'description': data['name']}
-            if 'media_metadata' in photo:
-                meta = photo['media_metadata']['photo_metadata']
-                r['camera_make'] = meta.get('camera_make')
-                r['camera_model'] = meta.get('camera_model')
-            yield r
+                yield from _album_photo(val, name)
+    for photo in pending:
+        yield from _album_photo(photo, name)
+    # Photo Album
+    yield {'action': 'album', 'action_type': 'post', 'person': ME,
+           'timestamp': modified, 'description': name}
 
-            # Photo Comments
-            for com in photo.get('comments', list()):
-                if com['author'] == ME:
-                    continue
-                yield {'action': 'comment', 'action_type': 'comment',
-                       'timestamp': com['timestamp'],
-                       'person': com['author'], 'description': com['comment'],
-                       'fbgroup': com.get('group')}
-
-    # posts
-    os.chdir(base_dir + 'posts')
-    data1 = json.load(open('your_posts.json'))
-    data2 = json.load(open("other_people's_posts_to_your_timeline.json"))
-    posts = data1['status_updates'] + data2['wall_posts_sent_to_you']
-    for row in posts:
-        r = {'action': 'post', 'action_type': 'post',
-             'timestamp': row['timestamp'], 'title': row.get('title')}
-        if 'data' in row:
-            r = parse_data(r, row)
-        if 'attachments' in row:
-            r = parse_attachments(r, row)
-        yield r
+def _album_photo(photo, album_name):
+    """Yield the action dicts for one album photo and its comments."""
+    if 'creation_timestamp' in photo:
+        ts = photo['creation_timestamp']
+    else:
+        if 'comments' in photo:
+            ts = min(c['timestamp'] for c in photo['comments'])
+        else:
+            ts = None
+    r = {'action': 'album_photo', 'action_type': 'post',
+         'timestamp': ts, 'url': photo['uri'], 'person': ME,
+         'description': album_name}
+    if 'media_metadata' in photo:
+        meta = photo['media_metadata']['photo_metadata']
+        r['camera_make'] = meta.get('camera_make')
+        r['camera_model'] = meta.get('camera_model')
+    yield r
 
-    # profile_information
-    os.chdir(base_dir + 'profile_information')
-    data = json.load(open('profile_update_history.json'))
+    # Photo Comments
+    for com in photo.get('comments', list()):
+        if com['author'] == ME:
+            continue
+        yield {'action': 'comment', 'action_type': 'comment',
+               'timestamp': com['timestamp'],
+               'person': com['author'], 'description': com['comment'],
+               'fbgroup': com.get('group')}
+
+def _read_posts(base, stream=True):
+    """Yield actions from posts."""
+    posts = (('your_posts.json', 'status_updates'),
+             ("other_people's_posts_to_your_timeline.json",
+              'wall_posts_sent_to_you'))
+    for path, posts_key in posts:
+        path = 'posts/' + path
+        for key, row in _read_json(base, path, (posts_key,), stream):
+            if key != posts_key:
+                continue
+            r = {'action': 'post', 'action_type': 'post',
+                 'timestamp': row['timestamp'], 'title': row.get('title')}
+            if 'data' in row:
+                r = parse_data(r, row)
+            if 'attachments' in row:
+                r = parse_attachments(r, row)
+            yield r
+
+def _read_profile(base, stream=True):
+    """Yield actions from profile_information."""
+    data = _load_json(base,
+                      'profile_information/profile_update_history.json')
     for row in data['profile_updates']:
         r = {'action': 'update_profile', 'action_type': 'update_profile',
              'timestamp': row['timestamp'], 'title': row.get('title')}
@@ -313,199 +567,689 @@ def process_files():
             r = parse_attachments(r, row)
         yield r
 
-def insert_row(cur, data):
-    """Insert a cleaned facebook action dict into SQLite's facebook table."""
-    # Build INSERT statement
-    q = "INSERT INTO facebook (" + ','.join(_db_cols) + ") \
-         VALUES (" + ','.join(['?']*len(_db_cols)) + ");"
-    # Build record to insert
-    row = tuple(data.get(c) for c in _db_cols)
-    cur.execute(q, row)
-
-def _prompt_cohort(db, cur):
-    cur.execute(SQL_GET_BLANK_COHORT)
-    friends = cur.fetchall()
-    if friends:
+def _source_tasks(base):
+    """List the (reader, args) tasks covering a Facebook export, in order.
+
+    Each messages/<chat> directory and photos_and_videos/album file is its
+    own task, so the tasks can be read independently of each other.
+    """
+    tasks = [(_read_apps, (base,)), (_read_comments, (base,)),
+             (_read_events, (base,)), (_read_friends, (base,)),
+             (_read_groups, (base,)), (_read_likes, (base,))]
+    for chat in sorted(_listdir(base, 'messages')):
+        if chat == 'stickers_used':
+            continue
+        tasks.append((_read_chat, (base, chat)))
+    for album in sorted(_listdir(base, 'photos_and_videos/album')):
+        tasks.append((_read_album, (base, album)))
+    tasks += [(_read_posts, (base,)), (_read_profile, (base,))]
+    return tasks
+
+# Files read by each fixed source reader, relative to the export directory
+_source_files = {
+    _read_apps: ['apps_and_websites/posts_from_apps_and_websites.json'],
+    _read_comments: ['comments/comments.json'],
+    _read_events: ['events/event_invitations.json',
+                   'events/your_event_responses.json',
+                   'events/your_events.json'],
+    _read_friends: ['friends/friends.json',
+                    'friends/received_friend_requests.json',
+                    'friends/rejected_friend_requests.json',
+                    'friends/removed_friends.json',
+                    'friends/sent_friend_requests.json'],
+    _read_groups: ['groups/your_groups.json'],
+    _read_likes: ['likes_and_reactions/pages.json',
+                  'likes_and_reactions/posts_and_comments.json'],
+    _read_posts: ['posts/your_posts.json',
+                  "posts/other_people's_posts_to_your_timeline.json"],
+    _read_profile: ['profile_information/profile_update_history.json'],
+    }
+
+def _task_files(reader, args):
+    """Return the export-relative paths of the files a source task reads."""
+    if reader is _read_chat:
+        return ['messages/' + args[1] + '/message.json']
+    if reader is _read_album:
+        return ['photos_and_videos/album/' + args[1]]
+    return _source_files[reader]
+
+def _file_entry(base, rel, old=None):
+    """Return a (path, size, mtime, hash) manifest entry for a source file.
+
+    The content hash is reused from the old entry when size and mtime are
+    unchanged, so only new or touched files are read to be hashed.
+    """
+    size, mtime = _stat(base, rel)
+    if old and old[:2] == (size, mtime):
+        return (rel,) + old
+    h = hashlib.sha1()
+    with _open(base, rel, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return (rel, size, mtime, h.hexdigest())
+
+def process_files(stream=True):
+    """Normalize contents of Facebook data files for easier processing.
+
+    Goes through each Facebook data export directory / JSON file, from
+    an unzipped export or straight from its zip file(s), and
+    normalizes the list into a series of dicts with the following keys:
+    -- action / action_type: categorization of action
+    -- timestamp: Unix timestamp of action
+    -- title: FB title of action
+    -- person: FB user who did action
+    -- with: FB user who action was done with/to (parsed from title)
+    -- fbgroup: FB group action was done in
+    -- description: comment / post text, album name, group name, etc.
+    -- thread: messages-only, ID of messanger thread
+    -- url: URL of shared link or photo
+    -- camera_make / camera_model: camera metadata from photos
+    -- fb_time / fb_month: timestamp in seconds and month bucket
+    Each action dict is emitted in sequence as a generator.
+    General FB JSON structure is to have a single key, whose value is
+    a list of actions / events.
+    The large messages, album and posts files are read incrementally
+    when stream is True, and loaded whole otherwise.
+    """
+    for reader, args in _source_tasks(base_dir):
+        yield from _read_task(reader, args, stream)
+
+def _read_task(reader, args, stream=True, titles=False):
+    """Yield the dated actions of one source task.
+
+    With titles, parse_title() is applied too, and actions are yielded as
+    compact_row() tuples rather than dicts. When instrumentation is
+    enabled, the time spent reading each of the task's files and matching
+    titles is recorded per file, with the peak allocation when tracing
+    memory, excluding the consumer's work between rows.
+    """
+    if not fb_instrument.ENABLED:
+        for i in reader(*args, stream=stream):
+            i = parse_date(i)
+            yield compact_row(parse_title(i)) if titles else i
+        return
+    global _last_opened
+    clock = time.perf_counter
+    actions = reader(*args, stream=stream)
+    # [read, parse_title, rows, peak_alloc] per file, in the order read
+    files = dict()
+    _last_opened = None
+    while True:
+        fb_instrument.reset_peak()
+        start = clock()
+        try:
+            i, done = parse_date(next(actions)), False
+        except StopIteration:
+            done = True
+        mid = clock()
+        if titles and not done:
+            i = compact_row(parse_title(i))
+        # Each row counts to the file the reader opened last
+        stats = files.setdefault(
+            _last_opened or _task_files(reader, args)[0], [0.0, 0.0, 0, 0])
+        stats[0] += mid - start
+        stats[1] += clock() - mid
+        stats[3] = max(stats[3], fb_instrument.peak_alloc() or 0)
+        if done:
+            break
+        stats[2] += 1
+        yield i
+    for name, (read, title, rows, peak) in files.items():
+        fields = {'parse_title': title}
+        if fb_instrument.TRACE_MEMORY:
+            fields['peak_alloc'] = peak
+        fb_instrument.record('source', name, read, rows, **fields)
+
+def _init_worker(me, base, instrument=(False, False)):
+    """Set the module globals a pool worker needs to read an export."""
+    global ME, base_dir
+    ME = me
+    base_dir = base
+    # Zip files opened before the fork must not share file offsets
+    _zip_exports.clear()
+    fb_instrument.init_worker(*instrument)
+
+def _run_task(reader, args, stream):
+    """Read one source task in a pool worker.
+
+    Returns its parsed action rows, and any instrumentation records made.
+    """
+    actions = list(_read_task(reader, args, stream, titles=True))
+    return actions, fb_instrument.drain()
+
+def _task_result(future):
+    """Return a finished _run_task()'s rows, keeping its records."""
+    actions, records = future.result()
+    fb_instrument.add(records)
+    return actions
+
+def ingest_actions(workers=1, stream=True, tasks=None):
+    """Yield title-parsed action rows from the export, using a process pool.
+
+    Rows are compact_row() tuples, which are also much cheaper to send back
+    from workers than dicts.
+    With workers > 1 each source task from _source_tasks() is read in a
+    worker process, and results are yielded in task order so the rows
+    match the serial path exactly. At most two tasks per worker are kept
+    in flight to bound memory held by unconsumed results. tasks limits
+    the ingest to a subset of the source tasks.
+    """
+    if tasks is None:
+        tasks = _source_tasks(base_dir)
+    if workers <= 1:
+        for reader, args in tasks:
+            yield from _read_task(reader, args, stream, titles=True)
+        return
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(ME, base_dir,
+                                       fb_instrument.state())) as pool:
+        pending = deque()
+        for reader, args in tasks:
+            pending.append(pool.submit(_run_task, reader, args, stream))
+            if len(pending) >= workers * 2:
+                yield from _task_result(pending.popleft())
+        while pending:
+            yield from _task_result(pending.popleft())
+
+def _compress(value):
+    """Return text as a zlib-compressed blob, if that makes it smaller."""
+    if value is None:
+        return None
+    data = value.encode('utf-8')
+    packed = zlib.compress(data)
+    return packed if len(packed) < len(data) else value
+
+def _decompress(value):
+    """Return text stored by _compress()."""
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+def _lean_rows(rows, text, first_id, side):
+    """Yield rows without their free text, numbered from first_id.
+
+    Unless text is 'drop', the description and title of each row having
+    any are appended to side as a facebook_text row, compressed if text
+    is 'zlib'.
+    """
+    desc, title = _text_cols
+    for row_id, row in enumerate(rows, first_id):
+        if row[desc] is not None or row[title] is not None:
+            if text == 'zlib':
+                side.append((row_id, _compress(row[desc]),
+                             _compress(row[title])))
+            elif text == 'side':
+                side.append((row_id, row[desc], row[title]))
+            row = list(row)
+            row[desc] = row[title] = None
+        yield (row_id,) + tuple(row)
+
+def get_text(db, mark=0):
+    """Yield (id, description, title) for each row with free text.
+
+    The text is read from wherever the row's ingest text mode put it.
+    Only rows after id mark are read.
+    """
+    for row_id, desc, title in db.execute(SQL_GET_TEXT, {'mark': mark}):
+        yield row_id, _decompress(desc), _decompress(title)
+
+def update_index(db, mark=0):
+    """Add rows after id mark to the full-text index, return how many.
+
+    The facebook_fts index is created and built in bulk from every row if
+    it does not exist yet.
+    """
+    cur = db.cursor()
+    cur.execute(SQL_CHECK_FTS)
+    build = not cur.fetchone()[0]
+    if build:
+        cur.execute(SQL_CREATE_FTS)
+        mark = 0
+    cur.executemany(SQL_INSERT_FTS, get_text(db, mark))
+    count = cur.rowcount
+    if build:
+        cur.execute(SQL_OPTIMIZE_FTS)
+    db.commit()
+    return count
+
+def _set_pragmas(cur, pragmas):
+    """Set pragmas from a {name: value} dict, return their old values."""
+    old = dict()
+    for name, value in pragmas.items():
+        old[name] = cur.execute('PRAGMA {};'.format(name)).fetchone()[0]
+        cur.execute('PRAGMA {}={};'.format(name, value))
+    return old
+
+def load_rows(db, rows, batch_size=BATCH_SIZE, text='keep'):
+    """Bulk insert action rows into the facebook table, return row count.
+
+    Rows are buffered into batches of batch_size and written with
+    executemany, all inside a single transaction with the bulk load
+    pragmas applied, or the safer incremental ones when the table already
+    has rows. The previous pragma values are restored afterwards.
+    A batch_size of 1 or less inserts rows one by one.
+    rows are compact_row() tuples, as yielded by ingest_actions().
+
+    text is one of TEXT_MODES. Anything but 'keep' leaves the description
+    and title columns empty, so the facebook table stays narrow and
+    scanning it reads fewer pages. 'side' and 'zlib' move the text to the
+    facebook_text table, see get_text().
+    """
+    cur = db.cursor()
+    cur.execute(SQL_MAX_ID)
+    mark = cur.fetchone()[0]
+    saved = _set_pragmas(cur, SQL_INCREMENTAL_PRAGMAS if mark
+                         else SQL_BULK_PRAGMAS)
+    start = time.time()
+    count = 0
+    insert_sql, side = _insert_sql, list()
+    if text != 'keep':
+        rows = _lean_rows(rows, text, mark + 1, side)
+        insert_sql = _insert_id_sql
+
+    def flush(batch):
+        cur.executemany(insert_sql, batch)
+        if side:
+            cur.executemany(SQL_INSERT_TEXT, side)
+            del side[:]
+        return len(batch)
+
+    try:
+        with fb_instrument.measure('insert', 'load_rows', text=text) as rec:
+            if batch_size <= 1:
+                for row in rows:
+                    count += flush([row])
+            else:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        count += flush(batch)
+                        batch = []
+                if batch:
+                    count += flush(batch)
+            db.commit()
+            rec['rows'] = count
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        _set_pragmas(cur, saved)
+    elapsed = time.time() - start
+    print('Loaded {:,} rows in {:.1f}s ({:,.0f} rows/sec)'.format(
+        count, elapsed, count / elapsed if elapsed else 0))
+    return count
+
+def ingest(db, workers=1, stream=True, incremental=False, text='keep',
+           fts=False):
+    """Load the export into the facebook table, return rows added.
+
+    Every file read is recorded in the manifest table with its size, mtime
+    and content hash. In incremental mode only tasks with a new or changed
+    file are read, and loaded rows whose natural key (action, action_type,
+    timestamp, person, thread) is already in the table are dropped, so a
+    newer export only adds its delta. text is passed to load_rows().
+    With fts, or if the database already has one, the full-text index is
+    brought up to date too.
+    """
+    cur = db.cursor()
+    cur.execute(SQL_CREATE_MANIFEST)
+    cur.execute(SQL_GET_MANIFEST)
+    manifest = {r[0]: r[1:] for r in cur.fetchall()}
+    all_tasks = _source_tasks(base_dir)
+    tasks, entries = list(), list()
+    for reader, args in all_tasks:
+        files = [_file_entry(base_dir, rel, manifest.get(rel))
+                 for rel in _task_files(reader, args)]
+        entries += [e for e in files if manifest.get(e[0]) != e[1:]]
+        # Re-read the task if any of its files has new content
+        hashes = [manifest.get(e[0], (None, None, None))[2] for e in files]
+        if not incremental or hashes != [e[3] for e in files]:
+            tasks.append((reader, args))
+    print('Reading {} of {} source tasks'.format(len(tasks), len(all_tasks)))
+
+    if incremental:
+        cur.execute(SQL_CREATE_KEY_INDEX)
+    cur.execute(SQL_MAX_ID)
+    mark = cur.fetchone()[0]
+    count = load_rows(db, ingest_actions(workers, stream, tasks), text=text)
+    with fb_instrument.measure('sql', 'SQL_CREATE_INDEXES'):
+        for q in SQL_CREATE_INDEXES:
+            cur.execute(q)
+    if incremental:
+        with fb_instrument.measure('sql', 'SQL_DEDUPE_ROWS') as rec:
+            cur.execute(SQL_DEDUPE_ROWS, {'mark': mark})
+            rec['rows'] = cur.rowcount
+        count -= cur.rowcount
+        cur.execute(SQL_DEDUPE_TEXT, {'mark': mark})
+    cur.executemany(SQL_UPDATE_MANIFEST, entries)
+    db.commit()
+    cur.execute(SQL_CHECK_FTS)
+    if fts or cur.fetchone()[0]:
+        with fb_instrument.measure('sql', 'update_index') as rec:
+            rec['rows'] = update_index(db, mark)
+        print('Indexed text of {:,} rows for search'.format(rec['rows']))
+    return count
+
+def _ask_cohorts(names):
+    """Prompt for the cohort of each named friend, return a mapping."""
+    if names:
         print("Group friends by how you met them")
         print("i.e. High School, Family, College, First Job, etc.")
         print("Each friend will be prompted, type the same group for")
         print("all friends that should be grouped together.")
-    for f in friends:
-        name = f[0]
-        cohort = input(name + ': ')
-        cur.execute(SQL_UPDATE_COHORT, (cohort, name))
-    db.commit()
+    return {name: input(name + ': ') for name in names}
+
+def _assign_cohorts(args, cohorts, cooccurrence):
+    """Return the friend to cohort mapping updated as args asks.
 
-def group_by(data, group_index):
-    """Group a list of lists by the data in position i. Returns array dict."""
-    dates = set()
-    grouped = defaultdict(lambda: defaultdict(int))
-    # Group data in dictionary
-    for row in data:
-        dates.add(row[0])
-        grouped[row[group_index]][row[0]] += row[-1]
-    # Sort dates, initialize "dataframe"
-    dates = sorted(dates)
-    dataframe = {'date': dates}
-    # Loop over dates, convert data dicts to numpy arrays
-    for key, vals in grouped.items():
-        dataframe[key] = np.array([vals[d] for d in dates])
-    return dataframe
+    cohorts maps every friend to their cohort, or None if not assigned
+    yet. cooccurrence() returns the memberships and interactions that
+    fb_cohort.infer_cohorts() clusters. Cohorts in --cohort-file override
+    inferred ones, and only friends still without one are prompted for.
+    """
+    cohorts = dict(cohorts)
+    if args.cohorts == 'auto':
+        import fb_cohort
+        with fb_instrument.measure('cohort', 'infer_cohorts') as rec:
+            cohorts.update(fb_cohort.infer_cohorts(cohorts, *cooccurrence()))
+            rec['rows'] = len(cohorts)
+        print('Inferred {} cohorts for {:,} friends'.format(
+            len(set(cohorts.values())), len(cohorts)))
+    if args.cohort_file:
+        import fb_cohort
+        overrides = fb_cohort.read_cohort_file(args.cohort_file)
+        cohorts.update((p, c) for p, c in overrides.items() if p in cohorts)
+    if args.cohorts == 'prompt':
+        cohorts.update(_ask_cohorts([p for p, c in cohorts.items()
+                                     if c is None]))
+    if args.save_cohorts:
+        import fb_cohort
+        fb_cohort.write_cohort_file(args.save_cohorts, cohorts)
+    return cohorts
 
 def get_data(cur, query):
     """Fetch data from database."""
     cur.execute(query)
     return list(cur.fetchall())
 
-def draw_chart(file_name, plotter, data, figsize, pct=False):
-    """Draw a figure using plotter function, save it as a png."""
-    # Initialize figure
-    fig, ax = plt.subplots(figsize=figsize)
-    # Set axis & tick parameters
-    ax.set_axisbelow(True)
-    ax.yaxis.grid()
-    ax.yaxis.set_tick_params(left=False, labelleft=True)
-    ax.yaxis.set_major_locator(ticker.MultipleLocator(50))
-    ax.xaxis.set_major_locator(ticker.MultipleLocator(1))
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    ax.spines['left'].set_visible(False)
-    # Override x-limits
-    ax.set_xlim([min(data['date']), max(data['date'])])
-    # If this is a % chart, set the tick and ylimits accordingly
-    if pct:
-        ax.yaxis.set_major_locator(ticker.MultipleLocator(0.25))
-        ax.yaxis.set_major_formatter(ticker.FuncFormatter('{0:.0%}'.format))
-        ax.set_ylim([0, 1])
-    # If this uses negatives to show other's posts, format away the minus
-    if file_name in ('wall_posts', 'messages'):
-        ax.yaxis.set_major_formatter(ticker.FuncFormatter(
-            lambda y, _: '{:,.0f}'.format(abs(y))
-            ))
-    # Call plotting function
-    plotter(ax, data)
-    # Draw PNG
-    plt.tight_layout()
-    fig.savefig(file_name + '.png')
-
-def add_title(ax, t):
-    ax.set_title(t, fontdict={'fontsize': 18}, loc='left')
-
-### Specific chart functions ###
-def posts_v_likes(ax, data):
-    """Draw stacked area chart of posts vs. likes."""
-    add_title(ax, 'Timeline of Facebook activity')
-    ax.set_ylabel('Actions per month')
-    ax.stackplot(data['date'], data['post'] + data['comment'] + data['event'],
-                 data['like'], labels=['Posts/Comments', 'Likes'],
-                 colors=[_colors['post'], _colors['like']],
-                 edgecolor='none')
-    ax.legend(loc='upper center')
-
-def pct_likes(ax, data):
-    """Draw area chart of % likes."""
-    add_title(ax, 'Likes as % of activity, by month')
-    ax.fill_between(data['date'], data['like'] / data['total'],
-                    color=_colors['like'])
-
-def friend_count(ax, data):
-    """Draw area chart of friend count."""
-    add_title(ax, 'Friends over time')
-    ax.fill_between(data['date'], data['total'], color=_colors['post'])
-    ax.set_ylim([0, data['total'].max()])
-
-def grouped_friend_count(ax, data):
-    """Draw stacked area chart of friend cohort counts."""
-    add_title(ax, 'Friend groups over time')
-    labs = [k for k in data.keys() if k not in ('date', 'total')]
-    ydat = [data[k] for k in labs]
-    ax.stackplot(data['date'], ydat, labels=labs)
-    ax.legend(loc='upper left')
-
-def post_balance(ax, data):
-    """Draw stacked area chart of post balance (me vs. others)."""
-    add_title(ax, 'Balance of Wall Posts, by month')
-    ax.fill_between(data['date'], data['other']*-1, color=_colors['comment'],
-                    label='Posts on my wall')
-    ax.stackplot(data['date'], data['me'], data['self'],
-                 colors=[_colors['like'], _colors['post']],
-                 labels=["My posts on other's walls",
-                         "My status updates / posts"])
-    handles, labels = ax.get_legend_handles_labels()
-    ax.legend(handles[::-1], labels[::-1], loc='upper center')
-
-def messages(ax, data):
-    """Draw stacked area chart of messages (sent vs. recieved)."""
-    add_title(ax, 'Facebook Messages (sent vs. recieved)')
-    ax.fill_between(data['date'], data['other']*-1, color=_colors['message'],
-                    label='Messages received')
-    ax.fill_between(data['date'], data['self'], color=_colors['message'],
-                    label='Messages sent')
-    ax.yaxis.set_major_locator(ticker.MultipleLocator(500))
-    ax.legend()
+def _execute(cur, name, query):
+    """Execute an fb_sql statement, recording it under name if enabled."""
+    with fb_instrument.measure('sql', name) as rec:
+        cur.execute(query)
+        rec['rows'] = cur.rowcount
 
-if __name__ == '__main__':
-    # Set paths, vars, initialize database
-    print('Enter your name as it appears on Facebook')
-    ME = input('Name: ')
-    PARSE = False
-    base_dir = os.getcwd()
-    db, cur, parse = init_db()
-
-    if parse:
-        print('Processing Facebook activity data')
-        # Load Facebook activity into database
-        for i in process_files():
-            insert_row(cur, parse_title(i))
-        db.commit()
-        os.chdir(base_dir)
-
-        # Try to estimate when removed friends were added
-        cur.execute(SQL_ESTIMATE_REMOVED_FRIENDS)
-        db.commit()
-
-        # Update friend mapping table
-        cur.execute(SQL_UPDATE_FRIEND_TABLE)
-        db.commit()
-        _prompt_cohort(db, cur)
-
-        # Convert timestamps to dates
-        cur.execute(SQL_FORMAT_DATES)
-        cur.execute(SQL_FORMAT_DATES_2)
-        db.commit()
-
-    # Create graphs folder if necessary
-    os.chdir(base_dir)
-    if 'graphs' not in os.listdir():
-        os.mkdir('graphs')
-    os.chdir('graphs')
+def _invalidate_cache(args):
+    """Drop cached chart data after the data it came from changed."""
+    import fb_cache
+    if fb_cache.invalidate(args.cache):
+        print('Cleared cached chart data in ' + args.cache)
+
+def _aggregate(kind, name, cache_dir, key, compute):
+    """Return compute()'s chart data, from cache_dir if key is cached."""
+    import fb_cache
+    with fb_instrument.measure(kind, name) as rec:
+        data, rec['cached'] = fb_cache.cached_columns(cache_dir, key, compute)
+        rec['rows'] = len(data[0])
+    return data
+
+def run_ingest(args):
+    """Load the export into the database or columnar store."""
+    print('Processing Facebook activity data')
+    if args.backend == 'columnar':
+        import fb_store
+        # The store is written whole, so is rewritten if any file changed
+        manifest = fb_store.load_manifest(args.store)
+        entries = {rel: _file_entry(base_dir, rel, manifest.get(rel))[1:]
+                   for reader, task in _source_tasks(base_dir)
+                   for rel in _task_files(reader, task)}
+        if args.incremental and ({p: e[2] for p, e in entries.items()} ==
+                                 {p: e[2] for p, e in manifest.items()}):
+            print('Store is up to date')
+            if entries != manifest:
+                fb_store.save_manifest(args.store, entries)
+            return
+        with fb_instrument.measure('insert', 'write_store') as rec:
+            rec['rows'] = fb_store.write_store(
+                args.store, ingest_actions(args.workers, args.stream),
+                _db_cols)
+        fb_store.save_manifest(args.store, entries)
+        print('Stored {:,} rows'.format(rec['rows']))
+        _invalidate_cache(args)
+        return
+    db, cur, parse = init_db(args.db)
+    if not parse and not args.incremental:
+        print('Database already loaded, use --incremental to update it')
+        return
+    ingest(db, args.workers, args.stream, incremental=not parse,
+           text=args.text, fts=args.fts)
+    _invalidate_cache(args)
+
+def run_postprocess(args):
+    """Estimate removed friends' adds and assign friend cohorts."""
+    if args.backend == 'columnar':
+        import fb_store
+        store = fb_store.open_store(args.store)
+        cohorts = {f: store['cohorts'].get(f)
+                   for f in fb_store.get_friends(store)}
+        cohorts = _assign_cohorts(args, cohorts,
+                                  lambda: fb_store.get_cooccurrence(store))
+        store['cohorts'].update((p, c) for p, c in cohorts.items()
+                                if c is not None)
+        fb_store.save_cohorts(args.store, store['cohorts'])
+        _invalidate_cache(args)
+        return
+    db, cur, parse = init_db(args.db)
+    # Try to estimate when removed friends were added
+    _execute(cur, 'SQL_DELETE_ESTIMATES', SQL_DELETE_ESTIMATES)
+    _execute(cur, 'SQL_ESTIMATE_REMOVED_FRIENDS', SQL_ESTIMATE_REMOVED_FRIENDS)
+    db.commit()
+
+    # Update friend mapping table
+    _execute(cur, 'SQL_UPDATE_FRIEND_TABLE', SQL_UPDATE_FRIEND_TABLE)
+    db.commit()
+    old = dict(get_data(cur, SQL_GET_COHORTS))
+    cohorts = _assign_cohorts(args, old, lambda: (
+        [get_data(cur, SQL_GET_THREAD_MEMBERS),
+         get_data(cur, SQL_GET_GROUP_MEMBERS)],
+        get_data(cur, SQL_GET_INTERACTIONS)))
+    # All changed assignments go in one batch
+    cur.executemany(SQL_UPDATE_COHORT, [(c, p) for p, c in cohorts.items()
+                                        if c != old[p]])
+    db.commit()
+    _invalidate_cache(args)
+
+def run_render(args):
+    """Draw the charts into the output directory."""
+    import fb_cache
+    import fb_charts
+    cache_dir = None if args.no_cache else args.cache
+    if args.backend == 'columnar':
+        import fb_store
+        files = [os.path.join(args.store, f) for f in os.listdir(args.store)]
+        store = lambda: fb_store.open_store(args.store)
+        action_data = _aggregate(
+            'aggregate', 'get_action_data', cache_dir,
+            fb_cache.fingerprint(files, 'get_action_data', ME),
+            lambda: fb_store.get_action_data(store(), ME))
+        friend_data = _aggregate(
+            'aggregate', 'get_friend_data', cache_dir,
+            fb_cache.fingerprint(files, 'get_friend_data'),
+            lambda: fb_store.get_friend_data(store()))
+    else:
+        # SQLite is only opened if a query's result is not cached
+        cur = lambda: init_db(args.db)[1]
+        params = {'me': ME}
+        action_data = _aggregate(
+            'sql', 'SQL_GET_ACTION_DATA', cache_dir,
+            fb_cache.fingerprint([args.db], SQL_GET_ACTION_DATA, params),
+            lambda: fb_charts.get_columns(cur(), SQL_GET_ACTION_DATA, params))
+        friend_data = _aggregate(
+            'sql', 'SQL_GET_FRIEND_DATA', cache_dir,
+            fb_cache.fingerprint([args.db], SQL_GET_FRIEND_DATA),
+            lambda: fb_charts.get_columns(cur(), SQL_GET_FRIEND_DATA))
+    os.makedirs(args.out, exist_ok=True)
+    print('Drawing charts of Facebook activity data')
+    fb_charts.draw_charts(action_data, friend_data, args.workers, args.out)
+
+def run_all(args):
+    """Run ingest, postprocess and render in sequence."""
+    run_ingest(args)
+    run_postprocess(args)
+    run_render(args)
+
+def run_stream(args):
+    """Draw the charts in one pass over the export, without a database."""
+    import fb_charts
+    import fb_stream
+    print('Processing Facebook activity data')
+    with fb_instrument.measure('aggregate', 'stream_totals') as rec:
+        totals = fb_stream.stream_totals(
+            ME, ingest_actions(args.workers, args.stream), _db_cols)
+        rec['rows'] = totals.rows
+    cohorts = None
+    if args.cohort_file:
+        import fb_cohort
+        cohorts = fb_cohort.read_cohort_file(args.cohort_file)
+    print('Counted {:,} rows into {:,} monthly totals'.format(
+        totals.rows, len(totals.counts)))
+    os.makedirs(args.out, exist_ok=True)
     print('Drawing charts of Facebook activity data')
+    fb_charts.draw_charts(totals.action_data(), totals.friend_data(cohorts),
+                          args.workers, args.out)
 
-    # Post vs. Likes Chart
-    data = get_data(cur, SQL_GET_ACTION_DATA % ME)
-    actions = group_by(data, group_index=2)
-    draw_chart('timeline', posts_v_likes, actions, (7, 5))
-
-    # Percent Likes Chart
-    excl = ['date', 'friend', 'message']
-    actions['total'] = sum([v for k, v in actions.items() if k not in excl])
-    draw_chart('percent_likes', pct_likes, actions, (7, 5), pct=True)
-
-    # Messages Chart
-    msg_data = [d for d in data if d[2] == 'message']
-    msgs = group_by(msg_data, group_index=1)
-    draw_chart('messages', messages, msgs, (7, 5))
-
-    # Post Balance Chart
-    data = [d for d in data if d[2] == 'post']
-    posts = group_by(data, group_index=1)
-    draw_chart('wall_posts', post_balance, posts, (7, 5))
-
-    # Friend Charts
-    data = get_data(cur, SQL_GET_FRIEND_DATA)
-    friends = group_by(data, group_index=1)
-    for k, v in friends.items():
-        friends[k] = np.cumsum(v) if k != 'date' else v
-    friends['total'] = sum([v for k, v in friends.items() if k != 'date'])
-    draw_chart('friends', friend_count, friends, (7, 5))
-    draw_chart('friends_cat', grouped_friend_count, friends, (7, 5))
+def run_search(args):
+    """Search message, comment and post text, optionally chart by month."""
+    db, cur, parse = init_db(args.db)
+    cur.execute(SQL_CHECK_FTS)
+    if not cur.fetchone()[0]:
+        print('No search index, run ingest with --incremental --fts first')
+        return
+    params = {'query': args.query, 'limit': args.limit}
+    try:
+        with fb_instrument.measure('sql', 'SQL_SEARCH') as rec:
+            rows = cur.execute(SQL_SEARCH, params).fetchall()
+            rec['rows'] = len(rows)
+    except sqlite3.OperationalError as e:
+        print('Invalid search query: {}'.format(e))
+        return
+    for ts, action, person, thread, desc, title in rows:
+        date = time.strftime('%Y-%m-%d', time.gmtime(ts)) if ts else '?'
+        text = _decompress(desc) or _decompress(title) or ''
+        text = ' '.join(text.split())
+        print('{} {:<10} {:<20} {}'.format(date, action, person or '',
+                                           text[:80]))
+    if args.chart:
+        import fb_charts
+        with fb_instrument.measure('sql', 'SQL_GET_TERM_DATA') as rec:
+            data = fb_charts.get_columns(cur, SQL_GET_TERM_DATA, params)
+            rec['rows'] = len(data[0])
+        os.makedirs(args.out, exist_ok=True)
+        fb_charts.draw_term_chart(data, args.query, args.out)
+
+def main(argv=None):
+    """Parse command line arguments and run the chosen stage."""
+    import argparse
+    global ME, base_dir
+    parser = argparse.ArgumentParser(
+        description='Parse a Facebook data export and chart the activity.')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--name', help='your name as it appears on Facebook')
+    common.add_argument('--export', nargs='+', default=['.'],
+                        help='Facebook export directory, or its zip file(s)')
+    common.add_argument('--db', default='facebook.sql',
+                        help='SQLite database path')
+    common.add_argument('--backend', choices=['sqlite', 'columnar'],
+                        default='sqlite', help='event storage backend')
+    common.add_argument('--store', default='facebook_store',
+                        help='columnar store directory')
+    common.add_argument('--cache', default='chart_cache',
+                        help='directory of cached chart data, cleared by '
+                        'ingest and postprocess')
+    common.add_argument('--workers', type=int, default=WORKERS,
+                        help='worker processes for ingest and rendering')
+    common.add_argument('--report', metavar='PATH',
+                        help='record per-file, per-statement and per-chart '
+                        'timings, rows and memory to a JSON report')
+    common.add_argument('--trace-memory', action='store_true',
+                        help='include peak Python allocations in the report')
+    common.add_argument('--profile', metavar='PATH',
+                        help='run the stage under cProfile, saving stats')
+    stages = {'ingest': run_ingest, 'postprocess': run_postprocess,
+              'render': run_render, 'all': run_all, 'stream': run_stream,
+              'search': run_search}
+    sub = parser.add_subparsers(dest='stage')
+    cmds = {name: sub.add_parser(name, parents=[common],
+                                 help=func.__doc__.rstrip('.'))
+            for name, func in stages.items()}
+    for name in ('ingest', 'all'):
+        cmds[name].add_argument('--incremental', action='store_true',
+                                help='only read new or changed export files; '
+                                'a columnar store is rewritten whole when '
+                                'any file changed')
+        cmds[name].add_argument('--no-stream', dest='stream',
+                                action='store_false',
+                                help='load JSON files whole')
+        cmds[name].add_argument('--text', choices=TEXT_MODES,
+                                default='keep',
+                                help='store description and title text in '
+                                'the facebook table, not at all, or in a '
+                                'side table, optionally zlib-compressed')
+        cmds[name].add_argument('--fts', action='store_true',
+                                help='build a full-text index for search, '
+                                'kept up to date by later ingests')
+    for name in ('postprocess', 'all'):
+        cmds[name].add_argument('--cohorts',
+                                choices=['prompt', 'auto', 'skip'],
+                                default='prompt',
+                                help='how to assign friend cohorts: ask for '
+                                'each, or cluster them by shared threads, '
+                                'groups and interactions')
+        cmds[name].add_argument('--cohort-file', metavar='CSV',
+                                help='person,cohort overrides to apply')
+        cmds[name].add_argument('--save-cohorts', metavar='CSV',
+                                help='write the person,cohort mapping')
+    for name in ('render', 'all'):
+        cmds[name].add_argument('--out', default='graphs',
+                                help='chart output directory')
+        cmds[name].add_argument('--no-cache', action='store_true',
+                                help='always query for the chart data')
+    cmds['stream'].add_argument('--no-stream', dest='stream',
+                                action='store_false',
+                                help='load JSON files whole')
+    cmds['stream'].add_argument('--cohort-file', metavar='CSV',
+                                help='person,cohort mapping of friends')
+    cmds['stream'].add_argument('--out', default='graphs',
+                                help='chart output directory')
+    cmds['search'].add_argument('query', help='FTS5 query, e.g. a word, '
+                                '"a phrase" or word1 OR word2')
+    cmds['search'].add_argument('--limit', type=int, default=20,
+                                help='most matches to list')
+    cmds['search'].add_argument('--chart', action='store_true',
+                                help='also chart matches per month')
+    cmds['search'].add_argument('--out', default='graphs',
+                                help='chart output directory')
+    # Without a stage, run them all as the script always used to
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in stages and argv[0] not in ('-h', '--help'):
+        argv = ['all'] + argv
+    args = parser.parse_args(argv)
+
+    if args.name is None and args.stage not in ('postprocess', 'search'):
+        print('Enter your name as it appears on Facebook')
+        args.name = input('Name: ')
+    ME = args.name
+    base_dir = export_source(args.export)
+    fb_instrument.enable(args.report is not None, args.trace_memory)
+    try:
+        with fb_instrument.profile(args.profile):
+            stages[args.stage](args)
+    finally:
+        # A later run may find other archives at the same paths
+        close_exports()
+    if args.report:
+        fb_instrument.write_report(args.report, stage=args.stage, argv=argv,
+                                   profile=args.profile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+import os
+import re
+import json
+import shutil
+import asyncio
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import fb_batch
+import fb_cache
+import fb_parse
+
+# Bytes of an uploaded zip read at a time
+CHUNK_SIZE = 1 << 20
+
+_reasons = {200: 'OK', 202: 'Accepted', 400: 'Bad Request',
+            404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error'}
+_chart_path = re.compile(r'^/charts/([0-9a-f]{64})\.png$')
+_job_path = re.compile(r'^/jobs/([0-9a-f]{40})(?:/(\w+)\.png)?$')
+
+def _export_files(export):
+    """List the files of an export given as directories or zip files."""
+    files = list()
+    for path in export:
+        if os.path.isdir(path):
+            for top, dirs, names in os.walk(path):
+                files += [os.path.join(top, n) for n in names]
+        else:
+            files.append(path)
+    return files
+
+def _store_chart(path, chart_dir):
+    """Copy a PNG into the content-addressed chart cache, return its hash."""
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    dest = os.path.join(chart_dir, digest + '.png')
+    if not os.path.exists(dest):
+        tmp = '{}.{}.tmp'.format(dest, os.getpid())
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, dest)
+    return digest
+
+def run_job(job_id, name, export, root, options=()):
+    """Ingest and render one job's export in a pool worker.
+
+    Runs the whole pipeline with fb_batch.run_user() in root/jobs/job_id,
+    then copies the charts into the root/charts cache. Returns the run's
+    summary, with a 'charts' mapping of chart names to their hashes.
+    The worker keeps no zip archive open from one job to the next.
+    """
+    try:
+        summary = fb_batch.run_user(job_id, name, export,
+                                    os.path.join(root, 'jobs'), options)
+    finally:
+        fb_parse.close_exports()
+    summary['charts'] = dict()
+    if summary['status'] == 'ok':
+        graphs = os.path.join(summary['out'], 'graphs')
+        for f in sorted(os.listdir(graphs)):
+            if f.endswith('.png'):
+                summary['charts'][f[:-len('.png')]] = _store_chart(
+                    os.path.join(graphs, f), os.path.join(root, 'charts'))
+    return summary
+
+class ChartServer:
+    """Queue chart jobs for a process pool, and serve the charts over HTTP.
+
+    Jobs are identified by a hash of the owner's name and the export's
+    contents, so resubmitting an export returns the finished job at once.
+    Charts are served from root/charts by the hash of their PNG data.
+    """
+
+    def __init__(self, root, workers=1, options=()):
+        self.root = root
+        self.workers = workers
+        self.options = ['--cohorts', 'auto', '--workers', '1'] + list(options)
+        self.jobs = dict()
+        for d in ('charts', 'jobs', 'uploads'):
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """Run the server until cancelled."""
+        self.queue = asyncio.Queue()
+        with ProcessPoolExecutor(self.workers) as pool:
+            runners = [asyncio.ensure_future(self._run_jobs(pool))
+                       for _ in range(self.workers)]
+            server = await asyncio.start_server(self._handle, host, port)
+            print('Serving on http://{}:{}/'.format(host, port))
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                for r in runners:
+                    r.cancel()
+
+    async def _run_jobs(self, pool):
+        """Run queued jobs one at a time in the process pool."""
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            job['status'] = 'running'
+            try:
+                summary = await loop.run_in_executor(
+                    pool, run_job, job['id'], job['name'], job['export'],
+                    self.root, self.options)
+                job.update(status=summary['status'], error=summary['error'],
+                           seconds=summary['seconds'],
+                           charts=summary['charts'])
+            except Exception as e:
+                job.update(status='failed',
+                           error='{}: {}'.format(type(e).__name__, e))
+            finally:
+                self.queue.task_done()
+
+    def submit(self, name, export, digest=None):
+        """Queue a job unless the same one is queued or done, return it.
+
+        digest identifies the export's contents, and defaults to a
+        fingerprint of its files' sizes and modification times.
+        """
+        if digest is None:
+            digest = fb_cache.fingerprint(_export_files(export))
+        job_id = hashlib.sha1(repr((name, digest)).encode()).hexdigest()
+        job = self.jobs.get(job_id)
+        if job is None or job['status'] == 'failed':
+            job = {'id': job_id, 'name': name, 'export': export,
+                   'status': 'queued', 'error': None, 'charts': dict()}
+            self.jobs[job_id] = job
+            self.queue.put_nowait(job)
+        return job
+
+    def _job_info(self, job):
+        """Return the public JSON description of a job."""
+        return {'id': job['id'], 'name': job['name'], 'status': job['status'],
+                'error': job['error'], 'seconds': job.get('seconds'),
+                'charts': {c: '/charts/{}.png'.format(h)
+                           for c, h in job['charts'].items()}}
+
+    async def _upload(self, reader, length):
+        """Save an uploaded zip under uploads by its hash.
+
+        Returns the path and the hash of the upload.
+        """
+        h = hashlib.sha1()
+        tmp = os.path.join(self.root, 'uploads', 'upload.{}.tmp'.format(
+            id(reader)))
+        with open(tmp, 'wb') as f:
+            while length > 0:
+                chunk = await reader.read(min(length, CHUNK_SIZE))
+                if not chunk:
+                    raise ValueError('upload ended early')
+                h.update(chunk)
+                f.write(chunk)
+                length -= len(chunk)
+        path = os.path.join(self.root, 'uploads', h.hexdigest() + '.zip')
+        os.replace(tmp, path)
+        return path, h.hexdigest()
+
+    async def _handle(self, reader, writer):
+        """Answer one HTTP request, then close the connection."""
+        try:
+            request = await reader.readline()
+            method, target, _ = request.decode('latin-1').split(' ', 2)
+            headers = dict()
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            status, body, ctype = await self._route(
+                method, url.path, parse_qs(url.query), headers, reader)
+        except ValueError as e:
+            status, body, ctype = 400, {'error': str(e)}, None
+        except Exception as e:
+            status, body, ctype = 500, {'error': str(e)}, None
+        if ctype is None:
+            body, ctype = json.dumps(body).encode(), 'application/json'
+        head = ['HTTP/1.1 {} {}'.format(status, _reasons[status]),
+                'Content-Type: ' + ctype,
+                'Content-Length: {}'.format(len(body)),
+                'Connection: close']
+        if ctype == 'image/png':
+            # Charts are content-addressed, so never change
+            head.append('Cache-Control: public, max-age=31536000, immutable')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, query, headers, reader):
+        """Dispatch a request, return (status, body, content type).
+
+        A content type of None means body is to be sent as JSON.
+        """
+        chart = _chart_path.match(path)
+        job = _job_path.match(path)
+        if path == '/jobs' and method == 'POST':
+            length = int(headers.get('content-length', 0))
+            if headers.get('content-type') == 'application/zip':
+                if 'name' not in query:
+                    return 400, {'error': 'name parameter required'}, None
+                name = query['name'][0]
+                path, digest = await self._upload(reader, length)
+                job = self.submit(name, [path], digest)
+            else:
+                data = json.loads(await reader.readexactly(length))
+                name, export = data.get('name'), data.get('export')
+                if isinstance(export, str):
+                    export = [export]
+                if not name or not export:
+                    return 400, {'error': 'name and export required'}, None
+                export = [os.path.abspath(p) for p in export]
+                if not all(os.path.exists(p) for p in export):
+                    return 400, {'error': 'export not found'}, None
+                job = self.submit(name, export)
+            status = 200 if job['status'] == 'ok' else 202
+            return status, self._job_info(job), None
+        if method != 'GET':
+            return 405, {'error': 'method not allowed'}, None
+        if path == '/jobs':
+            return 200, [self._job_info(j) for j in self.jobs.values()], None
+        if job and job.group(1) in self.jobs:
+            info = self.jobs[job.group(1)]
+            if job.group(2) is None:
+                return 200, self._job_info(info), None
+            if job.group(2) in info['charts']:
+                chart = _chart_path.match('/charts/{}.png'.format(
+                    info['charts'][job.group(2)]))
+        if chart:
+            path = os.path.join(self.root, 'charts', chart.group(1) + '.png')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return 200, f.read(), 'image/png'
+        return 404, {'error': 'not found'}, None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve Facebook activity charts over HTTP. POST a JSON '
+        '{"name", "export"} job, or a zip with ?name=, to /jobs, poll '
+        '/jobs/<id>, and fetch the charts it lists.')
+    parser.add_argument('--root', default='fb_server',
+                        help='directory for uploads, job data and charts')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on, local only by default')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=fb_parse.WORKERS,
+                        help='jobs run concurrently')
+    parser.add_argument('--backend', choices=['sqlite', 'columnar'],
+                        default='sqlite', help='event storage backend')
+    args = parser.parse_args()
+    server = ChartServer(args.root, args.workers,
+                         ['--backend', args.backend])
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,63 +1,172 @@
 SQL_CREATE = """
 CREATE TABLE IF NOT EXISTS facebook (
-  action text, action_type text, timestamp int, description text,
-  person text, thread text, title text, url text, fbgroup text,
-  camera_make text, camera_model text, fb_date datetime, with text
+  id integer PRIMARY KEY, action text, action_type text, timestamp int,
+  description text, person text, thread text, title text, url text,
+  fbgroup text, camera_make text, camera_model text, with text,
+  fb_time int, fb_month int
 );"""
 
+SQL_CREATE_FRIENDS = """
+CREATE TABLE IF NOT EXISTS friends (person text PRIMARY KEY, cohort text);"""
+
+# Free text moved out of the facebook table by a lean ingest, keyed by its
+# id. Values are text, or zlib-compressed UTF-8 as blobs.
+SQL_CREATE_TEXT = """
+CREATE TABLE IF NOT EXISTS facebook_text (
+  id integer PRIMARY KEY, description, title
+);"""
+SQL_INSERT_TEXT = "INSERT INTO facebook_text VALUES (?, ?, ?);"
+SQL_GET_TEXT = """
+SELECT f.id, coalesce(t.description, f.description),
+  coalesce(t.title, f.title)
+FROM facebook f LEFT JOIN facebook_text t ON t.id = f.id
+WHERE f.id > :mark
+  AND coalesce(t.description, f.description, t.title, f.title) IS NOT NULL;"""
+
+# Optional full-text index of the free text, keyed by facebook id. It is
+# contentless, as the text may be compressed in facebook_text.
+SQL_CREATE_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS facebook_fts
+  USING fts5(description, title, content='');"""
+SQL_CHECK_FTS = """
+SELECT count(*) FROM sqlite_master WHERE name = 'facebook_fts';"""
+SQL_INSERT_FTS = """
+INSERT INTO facebook_fts (rowid, description, title) VALUES (?, ?, ?);"""
+SQL_OPTIMIZE_FTS = """
+INSERT INTO facebook_fts (facebook_fts) VALUES ('optimize');"""
+SQL_SEARCH = """
+SELECT f.fb_time, f.action, f.person, f.thread,
+  coalesce(t.description, f.description), coalesce(t.title, f.title)
+FROM facebook_fts s JOIN facebook f ON f.id = s.rowid
+  LEFT JOIN facebook_text t ON t.id = f.id
+WHERE facebook_fts MATCH :query
+ORDER BY s.rank LIMIT :limit;"""
+SQL_GET_TERM_DATA = """
+SELECT f.fb_month, count(*)
+FROM facebook_fts s JOIN facebook f ON f.id = s.rowid
+WHERE facebook_fts MATCH :query AND f.fb_month IS NOT NULL
+GROUP BY f.fb_month;"""
+
+# Indexes built once the bulk load is done, rather than during inserts
+SQL_CREATE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS fb_person ON facebook (person, fb_time);",
+    "CREATE INDEX IF NOT EXISTS fb_with ON facebook (with, fb_time);",
+    "CREATE INDEX IF NOT EXISTS fb_action ON facebook (action_type, action);",
+    "CREATE INDEX IF NOT EXISTS fb_timestamp ON facebook (fb_time);",
+    "CREATE INDEX IF NOT EXISTS fb_month ON facebook (fb_month);",
+    ]
+
 SQL_CHECK = "SELECT count(*) FROM facebook;"
+SQL_GET_COLUMNS = "SELECT name FROM pragma_table_info('facebook');"
 
 SQL_DELETE = "DELETE FROM facebook;"
 
+SQL_CREATE_MANIFEST = """
+CREATE TABLE IF NOT EXISTS manifest (
+  path text PRIMARY KEY, size int, mtime real, hash text
+);"""
+SQL_GET_MANIFEST = "SELECT path, size, mtime, hash FROM manifest;"
+SQL_UPDATE_MANIFEST = "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?);"
+
+# Natural key used to deduplicate rows on incremental re-ingest
+SQL_CREATE_KEY_INDEX = """
+CREATE INDEX IF NOT EXISTS facebook_key
+  ON facebook (action, action_type, timestamp, person, thread);"""
+SQL_MAX_ID = "SELECT coalesce(max(id), 0) FROM facebook;"
+SQL_DEDUPE_ROWS = """
+DELETE FROM facebook WHERE id > :mark AND EXISTS (
+  SELECT 1 FROM facebook f WHERE f.id <= :mark
+    AND f.action IS facebook.action AND f.action_type IS facebook.action_type
+    AND f.timestamp IS facebook.timestamp AND f.person IS facebook.person
+    AND f.thread IS facebook.thread);"""
+SQL_DEDUPE_TEXT = """
+DELETE FROM facebook_text WHERE id > :mark
+  AND id NOT IN (SELECT id FROM facebook WHERE id > :mark);"""
+
+# Pragmas applied for the duration of a bulk load into an empty database,
+# with their previous values restored afterwards. Without a journal or
+# syncs a crash part way through can corrupt the database, but then
+# there is nothing in it to lose.
+SQL_BULK_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -200000,
+    }
+# Pragmas for loading into a database that already has rows. The journal
+# is kept, so a crash can lose the new rows but not the existing ones.
+SQL_INCREMENTAL_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -200000,
+    }
+
+SQL_DELETE_ESTIMATES = "DELETE FROM facebook WHERE action = 'accepted_est';"
+
+# First interaction with each removed friend is aggregated once per person,
+# then kept for each removal it precedes
 SQL_ESTIMATE_REMOVED_FRIENDS = """
-INSERT INTO facebook (action, action_type, person, timestamp)
-SELECT 'accepted_est', 'friend', f.person, (
-  SELECT min(timestamp) FROM facebook
-  WHERE action != 'removed' AND (person = f.person OR with = f.person)
-    AND timestamp <= f.timestamp) AS est_date
-FROM facebook f
-WHERE action_type = 'friend' AND action = 'removed'
-  AND est_date is not null;
+INSERT INTO facebook (action, action_type, person, timestamp, fb_time,
+                      fb_month)
+WITH removed AS (
+  SELECT person, fb_time FROM facebook
+  WHERE action_type = 'friend' AND action = 'removed'
+), first AS (
+  SELECT person, min(fb_time) AS ts FROM facebook
+  WHERE action != 'removed' AND person IN (SELECT person FROM removed)
+  GROUP BY person
+  UNION ALL
+  SELECT with, min(fb_time) FROM facebook
+  WHERE action != 'removed' AND with IN (SELECT person FROM removed)
+  GROUP BY with
+), est AS (
+  SELECT person, min(ts) AS ts FROM first GROUP BY person
+)
+SELECT 'accepted_est', 'friend', r.person, e.ts, e.ts,
+  cast(strftime('%Y', e.ts, 'unixepoch') AS INT) * 12 +
+    cast(strftime('%m', e.ts, 'unixepoch') AS INT) - 1
+FROM removed r JOIN est e ON e.person = r.person
+WHERE e.ts <= r.fb_time;
 """
 
 SQL_UPDATE_FRIEND_TABLE = """
 INSERT INTO friends (person)
-SELECT person FROM facebook WHERE action in ('accepted', 'accepted_est')
+SELECT DISTINCT person FROM facebook
+WHERE action in ('accepted', 'accepted_est')
   AND action_type = 'friend' AND person NOT IN (SELECT person FROM friends);
 """
 
-SQL_FORMAT_DATES = """
-UPDATE facebook SET fb_date=datetime(timestamp, 'unixepoch')
-  WHERE timestamp IS NOT NULL AND action != 'message';
-"""
-SQL_FORMAT_DATES_2 = """
-UPDATE facebook SET fb_date=datetime(timestamp/1000, 'unixepoch')
-  WHERE timestamp IS NOT NULL AND action = 'message';
-"""
-
 SQL_UPDATE_COHORT = "UPDATE friends SET cohort=? WHERE person=?;"
-SQL_GET_BLANK_COHORT = "SELECT person FROM friends WHERE cohort IS NULL;"
+SQL_GET_COHORTS = "SELECT person, cohort FROM friends;"
+
+# Co-occurrence of people, for inferring friend cohorts
+SQL_GET_THREAD_MEMBERS = """
+SELECT DISTINCT thread, person FROM facebook
+WHERE thread IS NOT NULL AND person IS NOT NULL;"""
+SQL_GET_GROUP_MEMBERS = """
+SELECT DISTINCT fbgroup, person FROM facebook
+WHERE fbgroup IS NOT NULL AND person IS NOT NULL;"""
+SQL_GET_INTERACTIONS = """
+SELECT person, with, count(*) FROM facebook
+WHERE person IS NOT NULL AND with IS NOT NULL AND person != with
+GROUP BY person, with;"""
 
 SQL_GET_ACTION_DATA = """
 SELECT
-  cast(strftime("%%Y", fb_date) AS FLOAT) +
-    (cast(strftime("%%m", fb_date) AS FLOAT) - 1) / 12 AS month,
-  --  ((cast(strftime("%%m", fb_date) AS INT) - 1) / 3) / 4.0 AS quarter,
-  CASE WHEN person = '%s' THEN
+  fb_month / 12.0 AS month,
+  --  (fb_month / 3) / 4.0 AS quarter,
+  CASE WHEN person = :me THEN
       CASE WHEN with IS NULL THEN 'self' ELSE 'me' END
   ELSE 'other' END AS person1,
   action_type, count(*)
 FROM facebook WHERE action != 'album_photo'
-  AND fb_date IS NOT NULL
-GROUP BY month, person1, action_type;"""
+  AND fb_month IS NOT NULL
+GROUP BY fb_month, person1, action_type;"""
 
 SQL_GET_FRIEND_DATA = """
 SELECT
-  cast(strftime("%Y", fb_date) AS FLOAT) +
-    (cast(strftime("%m", fb_date) AS FLOAT) - 1) / 12 AS month,
+  fb_month / 12.0 AS month,
   cohort,
   sum(CASE WHEN action LIKE 'accepted%' THEN 1 ELSE -1 END)
 FROM facebook f JOIN friends d ON f.person = d.person
 WHERE action_type = 'friend'
   AND action IN ('accepted', 'removed', 'accepted_est')
-GROUP BY month, cohort;"""
+GROUP BY fb_month, cohort;"""
@@ -0,0 +1,210 @@
+import os
+import json
+from array import array
+
+import numpy as np
+
+# Categorical columns, stored as int32 codes into the named vocabulary.
+# person and with share a vocabulary so their codes can be compared.
+_cat_cols = {
+    'action': 'action', 'action_type': 'action_type', 'person': 'person',
+    'with': 'person', 'thread': 'thread',
+    }
+# Integer columns and their array typecodes
+_int_cols = {'fb_time': 'q', 'fb_month': 'i'}
+# Stand-in for NULL in every column
+_NULL = -1
+
+def _months(ts):
+    """Return fb_month buckets for an array of timestamps in seconds."""
+    months = ts.astype('datetime64[s]').astype('datetime64[M]')
+    return months.astype(np.int64).astype(np.int32) + 1970 * 12
+
+def _estimate_removed(cols, vocab):
+    """Return columns of accepted_est rows for removed friends.
+
+    Mirrors SQL_ESTIMATE_REMOVED_FRIENDS: the estimate is the first
+    interaction with the person, kept when it precedes the removal.
+    """
+    action = vocab['action']
+    removed = action.get('removed', -2)
+    friend = vocab['action_type'].get('friend', -2)
+    ts = cols['fb_time']
+    first = np.full(len(vocab['person']), np.iinfo(np.int64).max)
+    valid = (cols['action'] != removed) & (ts != _NULL)
+    for c in ('person', 'with'):
+        sel = valid & (cols[c] != _NULL)
+        np.minimum.at(first, cols[c][sel], ts[sel])
+    rem = ((cols['action'] == removed) & (cols['action_type'] == friend)
+           & (cols['person'] != _NULL) & (ts != _NULL))
+    person = cols['person'][rem]
+    est = first[person]
+    keep = est <= ts[rem]
+    person, est = person[keep], est[keep]
+    n = len(person)
+    code = action.setdefault('accepted_est', len(action))
+    return {'action': np.full(n, code, np.int32),
+            'action_type': np.full(n, friend, np.int32),
+            'person': person.astype(np.int32),
+            'with': np.full(n, _NULL, np.int32),
+            'thread': np.full(n, _NULL, np.int32),
+            'fb_time': est, 'fb_month': _months(est)}
+
+def write_store(path, rows, columns):
+    """Write action rows to a columnar store in directory path.
+
+    rows are tuples of values for the named columns, as in fb_parse's
+    compact rows. Each column is saved as a .npy file, with categorical
+    values encoded against vocabularies saved in categories.json. Free
+    text columns are not stored. Estimated adds for removed friends are
+    appended, as in the SQLite post-processing. Any saved manifest is
+    cleared. Returns the number of rows written.
+    """
+    os.makedirs(path, exist_ok=True)
+    # Until the new manifest is saved, the store is never up to date
+    save_manifest(path, dict())
+    vocab = {v: dict() for v in _cat_cols.values()}
+    cols = {c: array('i') for c in _cat_cols}
+    cols.update({c: array(t) for c, t in _int_cols.items()})
+    cat = [(cols[c], vocab[v], columns.index(c)) for c, v in _cat_cols.items()]
+    ints = [(cols[c], columns.index(c)) for c in _int_cols]
+    for row in rows:
+        for out, values, i in cat:
+            val = row[i]
+            if val is None:
+                out.append(_NULL)
+            else:
+                out.append(values.setdefault(val, len(values)))
+        for out, i in ints:
+            val = row[i]
+            out.append(_NULL if val is None else int(val))
+    cols = {c: np.frombuffer(a, dtype=np.int32 if a.typecode == 'i'
+                             else np.int64) for c, a in cols.items()}
+    est = _estimate_removed(cols, vocab)
+    for c, a in cols.items():
+        np.save(os.path.join(path, c + '.npy'), np.concatenate([a, est[c]]))
+    with open(os.path.join(path, 'categories.json'), 'w') as f:
+        json.dump({v: list(d) for v, d in vocab.items()}, f)
+    return len(cols['action']) + len(est['action'])
+
+def open_store(path):
+    """Open a columnar store with its columns memory-mapped. Returns dict."""
+    store = {c: np.load(os.path.join(path, c + '.npy'), mmap_mode='r')
+             for c in list(_cat_cols) + list(_int_cols)}
+    with open(os.path.join(path, 'categories.json')) as f:
+        store['categories'] = json.load(f)
+    store['cohorts'] = load_cohorts(path)
+    return store
+
+def load_cohorts(path):
+    """Return the person to cohort mapping saved with a store."""
+    try:
+        with open(os.path.join(path, 'cohorts.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+def save_cohorts(path, cohorts):
+    """Save a person to cohort mapping with a store."""
+    with open(os.path.join(path, 'cohorts.json'), 'w') as f:
+        json.dump(cohorts, f, indent=1)
+
+def load_manifest(path):
+    """Return the {path: (size, mtime, hash)} source files of a store."""
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return {p: tuple(e) for p, e in json.load(f).items()}
+    except FileNotFoundError:
+        return dict()
+
+def save_manifest(path, manifest):
+    """Save the source files a store was written from, see load_manifest()."""
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+def _code(store, col, value):
+    """Return the code of value in a column, or -2 if it never occurs."""
+    values = store['categories'][_cat_cols[col]]
+    return values.index(value) if value in values else -2
+
+def _decode(values, codes):
+    """Map codes back to an array of values, with None for NULL."""
+    return np.array(list(values) + [None], dtype=object)[codes]
+
+def _friend_mask(store):
+    """Return the accepted / removed friend row mask and friends' codes."""
+    is_friend = store['action_type'] == _code(store, 'action_type', 'friend')
+    accepted = [_code(store, 'action', 'accepted'),
+                _code(store, 'action', 'accepted_est')]
+    rows = is_friend & np.isin(store['action'],
+                               accepted + [_code(store, 'action', 'removed')])
+    people = np.unique(store['person'][is_friend
+                                       & np.isin(store['action'], accepted)])
+    return rows, people[people != _NULL]
+
+def get_friends(store):
+    """Return the names of everyone in the friends table equivalent."""
+    names = store['categories']['person']
+    return [names[p] for p in _friend_mask(store)[1]]
+
+def get_cooccurrence(store):
+    """Return thread memberships and interactions for fb_cohort.
+
+    The equivalent of SQL_GET_THREAD_MEMBERS and SQL_GET_INTERACTIONS, as
+    a list of (thread, person) pair lists and (person, with, count) rows.
+    FB groups are not stored, so give no memberships.
+    """
+    names = store['categories']['person']
+    n = len(names)
+    person, thread, with_ = store['person'], store['thread'], store['with']
+    sel = (person != _NULL) & (thread != _NULL)
+    key = np.unique(thread[sel].astype(np.int64) * n + person[sel])
+    members = [(t, names[p]) for t, p in zip(key // n, key % n)]
+    sel = (person != _NULL) & (with_ != _NULL) & (person != with_)
+    key, counts = np.unique(person[sel].astype(np.int64) * n + with_[sel],
+                            return_counts=True)
+    interactions = [(names[p], names[w], c)
+                    for p, w, c in zip(key // n, key % n, counts)]
+    return [members], interactions
+
+def get_action_data(store, me):
+    """Equivalent of SQL_GET_ACTION_DATA, as get_columns() would return."""
+    month = store['fb_month']
+    keep = ((store['action'] != _code(store, 'action', 'album_photo'))
+            & (month != _NULL))
+    person = store['person'][keep]
+    # 0: other, 1: me, 2: self
+    person1 = np.where(person == _code(store, 'person', me),
+                       np.where(store['with'][keep] == _NULL, 2, 1), 0)
+    types = store['action_type'][keep].astype(np.int64) + 1
+    n_types = len(store['categories']['action_type']) + 1
+    key = (month[keep].astype(np.int64) * 3 + person1) * n_types + types
+    uniq, counts = np.unique(key, return_counts=True)
+    return [(uniq // (3 * n_types)) / 12.0,
+            np.array(['other', 'me', 'self'])[uniq // n_types % 3],
+            _decode(store['categories']['action_type'], uniq % n_types - 1),
+            counts]
+
+def get_friend_data(store):
+    """Equivalent of SQL_GET_FRIEND_DATA, as get_columns() would return."""
+    rows, people = _friend_mask(store)
+    names = store['categories']['person']
+    cohort = np.full(len(names) + 1, -2, np.int64)
+    values = sorted({store['cohorts'].get(names[p]) for p in people},
+                    key=lambda c: (c is None, c))
+    index = {c: i for i, c in enumerate(values)}
+    for p in people:
+        cohort[p] = index[store['cohorts'].get(names[p])]
+    rows &= (cohort[store['person']] != -2) & (store['fb_month'] != _NULL)
+    accepted = np.isin(store['action'][rows],
+                       [_code(store, 'action', 'accepted'),
+                        _code(store, 'action', 'accepted_est')])
+    n = max(len(values), 1)
+    key = (store['fb_month'][rows].astype(np.int64) * n
+           + cohort[store['person'][rows]])
+    uniq, idx = np.unique(key, return_inverse=True)
+    sums = np.bincount(idx, weights=np.where(accepted, 1, -1),
+                       minlength=len(uniq))
+    return [(uniq // n) / 12.0,
+            np.array(values + [None], dtype=object)[uniq % n],
+            sums.astype(np.int64)]
@@ -0,0 +1,108 @@
+import time
+from collections import Counter
+
+import numpy as np
+
+def _month(ts):
+    """Return the fb_month bucket of a timestamp in seconds."""
+    t = time.gmtime(ts)
+    return t.tm_year * 12 + t.tm_mon - 1
+
+class ChartTotals:
+    """Running chart data, updated one action row at a time.
+
+    Holds what SQL_GET_ACTION_DATA and SQL_GET_FRIEND_DATA would return
+    after post-processing, without storing the rows: counts per month,
+    self / me / other and action type, each friend's add and remove
+    events, and everyone's first interaction for the removed friend
+    estimate. Memory grows with months and people, not actions.
+    """
+
+    def __init__(self, me, columns):
+        self.me = me
+        self.rows = 0
+        self.counts = Counter()
+        self.friend_events = dict()
+        self.first = dict()
+        self._cols = [columns.index(c) for c in
+                      ('action', 'action_type', 'person', 'with', 'fb_time',
+                       'fb_month')]
+
+    def add(self, row):
+        """Count one row, a tuple of values in the columns order."""
+        action, action_type, person, with_, ts, month = [row[i] for i in
+                                                         self._cols]
+        self.rows += 1
+        self._count(action, action_type, person, with_, month)
+        if ts is not None and action is not None and action != 'removed':
+            for p in (person, with_):
+                if p is not None and ts < self.first.get(p, ts + 1):
+                    self.first[p] = ts
+        if (action_type == 'friend' and person is not None
+                and action in ('accepted', 'removed')):
+            self.friend_events.setdefault(person, list()).append(
+                (action, ts, month))
+
+    def _count(self, action, action_type, person, with_, month):
+        """Add a row to the SQL_GET_ACTION_DATA counts."""
+        if month is None or action is None or action == 'album_photo':
+            return
+        if person == self.me:
+            person1 = 'self' if with_ is None else 'me'
+        else:
+            person1 = 'other'
+        self.counts[(month, person1, action_type)] += 1
+
+    def estimate_removed(self):
+        """Add removed friends' accepted_est events, once all rows are in.
+
+        Estimates from the first interactions kept by add(), as
+        fb_store._estimate_removed() does from its columns.
+        """
+        for person, events in self.friend_events.items():
+            est = self.first.get(person)
+            if est is None:
+                continue
+            for action, ts, month in list(events):
+                if action == 'removed' and ts is not None and est <= ts:
+                    events.append(('accepted_est', est, _month(est)))
+                    self._count('accepted_est', 'friend', person, None,
+                                _month(est))
+
+    def action_data(self):
+        """Return the counts as SQL_GET_ACTION_DATA's columns."""
+        keys = sorted(self.counts, key=lambda k: (k[0], k[1], k[2] is None,
+                                                  k[2] or ''))
+        return [np.array([k[0] / 12.0 for k in keys]),
+                np.array([k[1] for k in keys]),
+                np.array([k[2] for k in keys]),
+                np.array([self.counts[k] for k in keys], dtype=np.int64)]
+
+    def friend_data(self, cohorts=None):
+        """Return friend adds less removes as SQL_GET_FRIEND_DATA's columns.
+
+        cohorts maps friends to their cohort, as the friends table would.
+        """
+        cohorts = cohorts or dict()
+        sums = Counter()
+        for person, events in self.friend_events.items():
+            # Only friends ever added are in the friends table
+            if not any(e[0] != 'removed' for e in events):
+                continue
+            cohort = cohorts.get(person)
+            for action, ts, month in events:
+                sums[(month, cohort)] += 1 if action != 'removed' else -1
+        keys = sorted(sums, key=lambda k: (k[0] is None, k[0] or 0,
+                                           k[1] is None, k[1] or ''))
+        return [np.array([None if k[0] is None else k[0] / 12.0
+                          for k in keys]),
+                np.array([k[1] for k in keys]),
+                np.array([sums[k] for k in keys], dtype=np.int64)]
+
+def stream_totals(me, rows, columns):
+    """Return the ChartTotals of every row, with removed friends estimated."""
+    totals = ChartTotals(me, columns)
+    for row in rows:
+        totals.add(row)
+    totals.estimate_removed()
+    return totals
@@ -0,0 +1,182 @@
+import os
+import json
+import random
+import argparse
+
+# Range of synthetic timestamps, 2008-01-01 to 2018-10-01
+_start, _end = 1199145600, 1538352000
+
+def _write(base, path, data):
+    """Write data as JSON to path under the export directory."""
+    path = os.path.join(base, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+def write_export(base, me='Pat Doe', threads=50, messages=500, friends=300,
+                 albums=10, photos=20, posts=300, seed=0):
+    """Write a synthetic Facebook export to directory base.
+
+    The layout and JSON structure match what process_files() reads, at a
+    scale set by the number of message threads, messages per thread,
+    friends, albums, photos per album and posts. Returns the row count
+    process_files() will yield.
+    """
+    rand = random.Random(seed)
+    ts = lambda: rand.randint(_start, _end)
+    people = ['Friend %d' % i for i in range(friends)]
+    other = lambda: rand.choice(people)
+    rows = 0
+
+    def post(title, text):
+        return {'timestamp': ts(), 'title': title, 'data': [{'post': text}]}
+
+    # apps_and_websites
+    apps = [{'timestamp': ts(), 'title': me + ' shared a link.',
+             'attachments': [{'data': [{'external_context': {
+                 'name': 'Article %d' % i, 'url': 'https://example.com/%d' % i
+                 }}]}]} for i in range(posts // 10)]
+    _write(base, 'apps_and_websites/posts_from_apps_and_websites.json',
+           {'app_posts': apps})
+    rows += len(apps)
+
+    # comments
+    comments = [{'timestamp': ts(),
+                 'title': "%s commented on %s's post." % (me, other()),
+                 'data': [{'comment': {'timestamp': ts(), 'author': me,
+                                       'comment': 'Comment %d' % i}}]}
+                for i in range(posts)]
+    _write(base, 'comments/comments.json', {'comments': comments})
+    rows += len(comments)
+
+    # events
+    event = lambda i: {'start_timestamp': ts(), 'name': 'Event %d' % i}
+    events = {k: [event(i) for i in range(friends // 20)]
+              for k in ('events_joined', 'events_declined',
+                        'events_interested')}
+    _write(base, 'events/event_invitations.json',
+           {'events_invited': [event(i) for i in range(friends // 10)]})
+    _write(base, 'events/your_event_responses.json',
+           {'event_responses': events})
+    _write(base, 'events/your_events.json',
+           {'your_events': [event(i) for i in range(3)]})
+    rows += friends // 10 + 3 * (friends // 20) + 3
+
+    # friends, with a tenth of them since removed
+    removed = people[:friends // 10]
+    friend = lambda name: {'name': name, 'timestamp': ts()}
+    _write(base, 'friends/friends.json',
+           {'friends': [friend(p) for p in people[friends // 10:]]})
+    _write(base, 'friends/received_friend_requests.json',
+           {'received_requests': [friend('Stranger %d' % i)
+                                  for i in range(friends // 20)]})
+    _write(base, 'friends/rejected_friend_requests.json',
+           {'rejected_requests': [friend('Stranger %d' % i)
+                                  for i in range(friends // 40)]})
+    _write(base, 'friends/removed_friends.json',
+           {'deleted_friends': [{'name': p, 'timestamp': _end}
+                                for p in removed]})
+    _write(base, 'friends/sent_friend_requests.json',
+           {'sent_requests': [friend(p) for p in people[:friends // 5]]})
+    rows += (friends - friends // 10 + friends // 20 + friends // 40
+             + len(removed) + friends // 5)
+
+    # groups
+    _write(base, 'groups/your_groups.json',
+           {'groups_admined': [{'timestamp': ts(), 'name': 'Group %d' % i}
+                               for i in range(3)]})
+    rows += 3
+
+    # likes_and_reactions
+    _write(base, 'likes_and_reactions/pages.json',
+           {'page_likes': [{'timestamp': ts(), 'data': [{'name': 'Page %d'
+                                                         % i}]}
+                           for i in range(friends // 5)]})
+    verbs = ['likes', 'liked', 'reacted to']
+    reactions = [{'timestamp': ts(),
+                  'title': "%s %s %s's post." % (me, rand.choice(verbs),
+                                                 other()),
+                  'data': [{'reaction': {'reaction': 'LIKE', 'actor': me}}]}
+                 for _ in range(posts * 3)]
+    _write(base, 'likes_and_reactions/posts_and_comments.json',
+           {'reactions': reactions})
+    rows += friends // 5 + len(reactions)
+
+    # messages
+    for t in range(threads):
+        members = [me] + rand.sample(people, min(len(people),
+                                                 rand.randint(1, 3)))
+        chat = 'friend%d_%d' % (t, rand.randint(10 ** 9, 10 ** 10))
+        msgs = [{'sender_name': rand.choice(members),
+                 'timestamp_ms': ts() * 1000 + rand.randint(0, 999),
+                 'content': 'Message %d in thread %d' % (i, t),
+                 'type': 'Generic'} for i in range(messages)]
+        _write(base, 'messages/%s/message.json' % chat,
+               {'participants': [{'name': m} for m in members[1:]],
+                'messages': msgs, 'title': chat, 'is_still_participant':
+                True, 'thread_type': 'Regular'})
+        rows += len(msgs)
+    os.makedirs(os.path.join(base, 'messages', 'stickers_used'),
+                exist_ok=True)
+
+    # photos_and_videos
+    for a in range(albums):
+        pics = list()
+        for p in range(photos):
+            pic = {'uri': 'photos_and_videos/album%d/%d.jpg' % (a, p),
+                   'creation_timestamp': ts(),
+                   'media_metadata': {'photo_metadata': {
+                       'camera_make': 'Camera', 'camera_model': 'Model %d'
+                       % (p % 3)}},
+                   'comments': [{'timestamp': ts(), 'author': other(),
+                                 'comment': 'Nice'}
+                                for _ in range(rand.randint(0, 2))]}
+            pics.append(pic)
+            rows += 1 + len(pic['comments'])
+        album_comments = [{'timestamp': ts(), 'author': other(),
+                           'comment': 'Great album'}]
+        _write(base, 'photos_and_videos/album/%d.json' % a,
+               {'name': 'Album %d' % a, 'photos': pics,
+                'cover_photo': pics[0] if pics else None,
+                'last_modified_timestamp': ts(),
+                'comments': album_comments})
+        rows += 1 + len(album_comments)
+
+    # posts
+    status = [post('%s wrote on %s timeline.' % (me, rand.choice(
+                   ['your', "%s's" % other()])), 'Post %d' % i)
+              for i in range(posts)]
+    wall = [post('%s wrote on your timeline.' % other(), 'Wall %d' % i)
+            for i in range(posts // 2)]
+    _write(base, 'posts/your_posts.json', {'status_updates': status})
+    _write(base, "posts/other_people's_posts_to_your_timeline.json",
+           {'wall_posts_sent_to_you': wall})
+    rows += len(status) + len(wall)
+
+    # profile_information
+    _write(base, 'profile_information/profile_update_history.json',
+           {'profile_updates': [{'timestamp': ts(),
+                                 'title': me + ' updated their profile.'}
+                                for _ in range(5)]})
+    rows += 5
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic Facebook data export.')
+    parser.add_argument('out', help='export directory to create')
+    parser.add_argument('--name', default='Pat Doe')
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=500,
+                        help='messages per thread')
+    parser.add_argument('--friends', type=int, default=300)
+    parser.add_argument('--albums', type=int, default=10)
+    parser.add_argument('--photos', type=int, default=20,
+                        help='photos per album')
+    parser.add_argument('--posts', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rows = write_export(args.out, args.name, args.threads, args.messages,
+                        args.friends, args.albums, args.photos, args.posts,
+                        args.seed)
+    print('Wrote {} ({:,} actions)'.format(args.out, rows))